@@ -0,0 +1,249 @@
+import asyncio
+import base64
+import copy
+import re
+import smtplib
+import socket
+import ssl
+import time
+from email.utils import getaddresses
+
+from timing import timed
+
+
+def _b64(text):
+    return base64.b64encode(text.encode("utf-8")).decode("ascii")
+
+
+class AsyncSMTPClient:
+    # Minimal asyncio SMTP client: EHLO, STARTTLS, AUTH PLAIN/LOGIN and
+    # MAIL/RCPT/DATA. Errors are raised as the matching smtplib exceptions so
+    # callers can handle both transports the same way.
+    def __init__(self, host, port, username=None, password=None, security="starttls", timeout=60, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.security = security
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.local_hostname = socket.getfqdn()
+        self.extensions = {}
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        tls = (self.ssl_context or ssl.create_default_context()) if self.security == "ssl" else None
+        with timed("send.connect"):
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=tls), self.timeout
+            )
+        try:
+            with timed("send.connect"):
+                code, msg = await self._reply()
+                if code != 220:
+                    raise smtplib.SMTPConnectError(code, msg)
+                await self._ehlo()
+            if self.security == "starttls":
+                if "starttls" not in self.extensions:
+                    raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+                with timed("send.tls"):
+                    code, msg = await self.command("STARTTLS")
+                    if code != 220:
+                        raise smtplib.SMTPResponseException(code, msg)
+                    await self.writer.start_tls(self.ssl_context or ssl.create_default_context(), server_hostname=self.host)
+                    await self._ehlo()
+            if self.username:
+                with timed("send.auth"):
+                    await self._login()
+        except Exception:
+            self.close()
+            raise
+
+    async def command(self, line):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+        try:
+            self.writer.write(line.encode("utf-8") + b"\r\n")
+            await self.writer.drain()
+        except ConnectionError as e:
+            self.close()
+            raise smtplib.SMTPServerDisconnected(str(e))
+        return await self._reply()
+
+    async def noop(self):
+        return await self.command("NOOP")
+
+    async def send_message(self, msg):
+        sender = getaddresses([msg["From"]])[0][1]
+        recipients = [addr for _, addr in getaddresses(msg.get_all("To", []) + msg.get_all("Cc", []) + msg.get_all("Bcc", []))]
+        if msg["Bcc"] is not None:
+            msg = copy.copy(msg)
+            del msg["Bcc"]
+
+        code, resp = await self.command(f"MAIL FROM:<{sender}>")
+        if code != 250:
+            await self._rset()
+            raise smtplib.SMTPSenderRefused(code, resp, sender)
+
+        refused = {}
+        for recipient in recipients:
+            code, resp = await self.command(f"RCPT TO:<{recipient}>")
+            if code not in (250, 251):
+                refused[recipient] = (code, resp)
+        if len(refused) == len(recipients):
+            await self._rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = await self.command("DATA")
+        if code != 354:
+            await self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+
+        data = msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+        data = re.sub(rb"(?m)^\.", b"..", data)
+        if not data.endswith(b"\r\n"):
+            data += b"\r\n"
+        try:
+            self.writer.write(data + b".\r\n")
+            await self.writer.drain()
+        except ConnectionError as e:
+            self.close()
+            raise smtplib.SMTPServerDisconnected(str(e))
+        code, resp = await self._reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    async def quit(self):
+        try:
+            await self.command("QUIT")
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _reply(self):
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self.close()
+                raise smtplib.SMTPServerDisconnected(str(e))
+            except asyncio.TimeoutError:
+                # The late reply would answer the next command; like smtplib, drop the connection
+                self.close()
+                raise smtplib.SMTPServerDisconnected(f"No reply within {self.timeout}s")
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip())
+            if line[3:4] != b"-":
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b"\n".join(lines)
+
+    async def _ehlo(self):
+        code, msg = await self.command(f"EHLO {self.local_hostname}")
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, msg)
+        self.extensions = {}
+        for line in msg.decode("latin-1").split("\n")[1:]:
+            name, _, params = line.partition(" ")
+            self.extensions[name.lower()] = params
+
+    async def _login(self):
+        methods = self.extensions.get("auth", "").upper().split()
+        if "PLAIN" in methods:
+            code, msg = await self.command("AUTH PLAIN " + _b64(f"\0{self.username}\0{self.password}"))
+        elif "LOGIN" in methods:
+            code, msg = await self.command("AUTH LOGIN")
+            if code == 334:
+                code, msg = await self.command(_b64(self.username))
+            if code == 334:
+                code, msg = await self.command(_b64(self.password))
+        else:
+            raise smtplib.SMTPNotSupportedError("No suitable authentication method found.")
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, msg)
+
+    async def _rset(self):
+        try:
+            await self.command("RSET")
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+
+class AsyncSMTPSession:
+    # asyncio counterpart of smtp.SMTPSession: lazy connect, one transparent
+    # reconnect on disconnect and recycling after max_messages
+    def __init__(self, email_settings):
+        self.email_settings = email_settings
+        self.host = email_settings.get("smtp_host", "smtp.gmail.com")
+        self.port = email_settings.get("smtp_port", 587)
+        self.security = email_settings.get("smtp_security", "starttls")
+        self.max_messages = email_settings.get("max_messages_per_connection", 100)
+        self.timeout = email_settings.get("timeout_seconds", 60)
+        self.messages_sent = 0
+        self.connections_opened = 0
+        self.busy_seconds = 0.0
+        self._client = None
+        self._sent_on_connection = 0
+
+    async def connect(self):
+        await self.close()
+        client = AsyncSMTPClient(
+            self.host,
+            self.port,
+            self.email_settings["sender_email"],
+            self.email_settings["sender_password"],
+            security=self.security,
+            timeout=self.timeout,
+        )
+        await client.connect()
+        self._client = client
+        self._sent_on_connection = 0
+        self.connections_opened += 1
+
+    async def send(self, msg):
+        start = time.monotonic()
+        if self._client is None or self._client.writer is None or self._sent_on_connection >= self.max_messages:
+            await self.connect()
+        try:
+            with timed("send.data"):
+                await self._client.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            await self.connect()
+            with timed("send.data"):
+                await self._client.send_message(msg)
+        self._sent_on_connection += 1
+        self.messages_sent += 1
+        self.busy_seconds += time.monotonic() - start
+
+    async def keepalive(self):
+        if self._client is None or self._client.writer is None:
+            return
+        try:
+            code, _ = await self._client.noop()
+        except (smtplib.SMTPException, OSError):
+            code = None
+        if code != 250:
+            self.reset()
+
+    def reset(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.quit()
+            self._client = None
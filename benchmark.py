@@ -0,0 +1,408 @@
+import argparse
+import contextlib
+import copy
+import csv
+import io
+import json
+import os
+import re
+import resource
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from PIL import Image, ImageDraw
+
+import main as mailer
+from smtp import AsyncSMTPPool, SMTPPool
+from timing import Metrics, collect_timings
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_sink(*extra_args):
+    # The sink runs in its own process so it does not compete for our GIL
+    port = free_port()
+    sink = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "smtp_sink.py"), "--port", str(port), *extra_args],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    sink.stdout.readline()
+    return sink, port
+
+
+def stop_sink(sink):
+    # SIGINT makes the sink print its counters as one JSON line
+    sink.send_signal(signal.SIGINT)
+    out, _ = sink.communicate()
+    lines = out.strip().splitlines()
+    return json.loads(lines[-1]) if lines else {}
+
+
+def bench_settings(connections, port):
+    return {
+        "sender_email": "bench@example.com",
+        "sender_password": "bench",
+        "smtp_host": "127.0.0.1",
+        "smtp_port": port,
+        "smtp_security": "none",
+        "connections": connections,
+        "max_messages_per_connection": 1000,
+        "keepalive_seconds": 0,
+    }
+
+
+def peak_rss_mb():
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+
+def write_recipients(path, count, groups):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "email", "piORth"])
+        for i in range(count):
+            writer.writerow([f"Recipient Number {i}", f"recipient{i}@example.com", groups[i % len(groups)]])
+
+
+def run_transport(pool_class, connections, port, messages, attachment):
+    settings = bench_settings(connections, port)
+    template = {"email_subject": "Benchmark", "email_body": "Dear {name},\nbenchmark message."}
+    finished = threading.Event()
+    outcomes = {"ok": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def done(error):
+        with lock:
+            outcomes["failed" if error else "ok"] += 1
+            if outcomes["ok"] + outcomes["failed"] == messages:
+                finished.set()
+
+    pool = pool_class(settings)
+    start = time.perf_counter()
+    for i in range(messages):
+        msg = mailer.build_email(f"Person {i}", f"p{i}@example.com", attachment, "certificate.pdf", template, settings)
+        pool.submit(msg, done)
+    finished.wait()
+    elapsed = time.perf_counter() - start
+    pool.close()
+    return elapsed, outcomes
+
+
+def cmd_transport(args):
+    sink, port = start_sink("--latency", str(args.latency))
+    attachment = os.urandom(args.attachment_kb * 1024)
+    print(f"{args.messages} messages, {args.attachment_kb} KB attachment, {args.latency * 1000:.0f} ms sink latency\n")
+    try:
+        for name, pool_class, connections in (
+            ("sync", SMTPPool, args.sync_connections),
+            ("async", AsyncSMTPPool, args.async_connections),
+        ):
+            elapsed, outcomes = run_transport(pool_class, connections, port, args.messages, attachment)
+            print(
+                f"{name:<6} {connections:>4} connections  {args.messages / elapsed:8.1f} msg/s  "
+                f"({elapsed:.2f}s, {outcomes['failed']} failed)"
+            )
+    finally:
+        stop_sink(sink)
+
+
+def cmd_e2e(args):
+    sink_args = ["--latency", str(args.latency), "--throttle-rate", str(args.throttle_rate)]
+    sink_args += ["--disconnect-rate", str(args.disconnect_rate), "--seed", "1"]
+    if args.verify:
+        sink_args.append("--verify")
+    sink, port = start_sink(*sink_args)
+
+    with open(args.config, "r") as f:
+        base = json.load(f)
+    config_dir = os.path.dirname(os.path.abspath(args.config))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        config = copy.deepcopy(base)
+        for template in config["templates"].values():
+            template["template_path"] = os.path.join(config_dir, template["template_path"])
+            template["font_path"] = os.path.join(config_dir, template["font_path"])
+            if args.render_mode:
+                template["render_mode"] = args.render_mode
+        config["input_csv"] = os.path.join(workdir, "recipients.csv")
+        config["output_folder"] = os.path.join(workdir, "output")
+        config["archive_output"] = args.archive
+        config["ledger_path"] = os.path.join(workdir, "ledger.sqlite3")
+        config["dead_letter_csv"] = os.path.join(workdir, "dead_letter.csv")
+        config["metrics_json"] = args.metrics_json
+        # A warm render cache would hide the renderer from the measurement
+        config["render_cache_dir"] = None
+        config["retry_base_seconds"] = 0.1
+        settings = config["email_settings"]
+        settings.update(bench_settings(args.connections, port))
+        settings.update({"transport": args.transport, "max_per_second": None, "max_per_day": None})
+        write_recipients(config["input_csv"], args.recipients, sorted(config["templates"]))
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            summary = mailer.run(config, args.render_workers, args.recipients)
+
+    sink_stats = stop_sink(sink)
+    own_rss, children_rss = peak_rss_mb()
+
+    print(
+        f"{args.recipients} recipients, render_mode={args.render_mode or 'as configured'}, "
+        f"{args.render_workers} render worker(s), {args.transport} transport x {args.connections}\n"
+    )
+    print(f"Certificates/sec: {summary['success'] / summary['elapsed']:.1f}")
+    print(f"Sent {summary['success']}, failed {summary['failed']}, retried {summary['retried']} in {summary['elapsed']:.2f}s")
+    print(f"Sink: {sink_stats}")
+    print(f"Peak RSS: {own_rss:.0f} MB (render workers: {children_rss:.0f} MB)\n")
+    print(f"{'stage':<8} {'p50 ms':>10} {'p99 ms':>10}")
+    for stage, stats in summary["latency"].items():
+        print(f"{stage:<8} {stats['p50'] * 1000:10.1f} {stats['p99'] * 1000:10.1f}")
+    print()
+    for stats in summary["stages"]:
+        print(f"{stats['stage']:<8} {stats['utilization']:6.0%} busy, queue max {stats['max_depth']}")
+    print()
+    print(f"{'step':<16} {'mean ms':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for step, stats in summary["steps"].items():
+        print(f"{step:<16} {stats['mean_ms']:10.2f} {stats['p50_ms']:10.2f} {stats['p99_ms']:10.2f}")
+
+
+def scaled_template(template, config_dir, scale, workdir):
+    # The configured template upscaled, standing in for print-resolution artwork
+    scaled = dict(template)
+    source = os.path.join(config_dir, template["template_path"])
+    scaled["template_path"] = os.path.join(workdir, f"{scale}x-{os.path.basename(source)}")
+    with Image.open(source) as image:
+        image.resize((image.width * scale, image.height * scale)).save(scaled["template_path"], quality=95)
+    scaled["font_path"] = os.path.join(config_dir, template["font_path"])
+    scaled["font_size"] = template["font_size"] * scale
+    scaled["text_position"] = [coord * scale for coord in template["text_position"]]
+    return scaled
+
+
+def cmd_compositing(args):
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    config_dir = os.path.dirname(os.path.abspath(args.config))
+    group = args.group or sorted(config["templates"])[0]
+
+    print(f"Template {group!r}, {args.repeat} renders per row; times are means per certificate\n")
+    print(f"{'scale':<6} {'size':>11} {'engine':<10} {'template ms':>12} {'draw ms':>10} {'encode ms':>10} {'total ms':>10}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for scale in args.scales:
+            template = scaled_template(config["templates"][group], config_dir, scale, workdir)
+            for mode in ("raster", "composite"):
+                template["render_mode"] = mode
+                mailer.render_certificate("Warm Up", template)
+                metrics = Metrics()
+                start = time.perf_counter()
+                for i in range(args.repeat):
+                    with collect_timings() as timings:
+                        mailer.render_certificate(f"Recipient Number {i}", template)
+                    metrics.merge(timings)
+                total = (time.perf_counter() - start) / args.repeat
+                steps = metrics.report()
+                size = mailer.template_cache.get(template["template_path"], mailer.template_mode(template)).size
+                print(
+                    f"{scale}x{'':<4} {size[0]:>5}x{size[1]:<5} {mode:<10}"
+                    f" {steps['render.template']['mean_ms']:12.1f} {steps['render.draw']['mean_ms']:10.1f}"
+                    f" {steps['render.encode']['mean_ms']:10.1f} {total * 1000:10.1f}"
+                )
+            mailer.template_cache.clear()
+
+
+def legacy_frame(name, template):
+    # The frame the raster path drew before pixel modes were picked per format:
+    # an RGBA copy of the template with the name drawn on it
+    image = mailer.decode_template(template["template_path"], "RGBA")
+    draw = ImageDraw.Draw(image)
+    font = mailer.font_registry.get(template["font_path"], template["font_size"], template.get("font_variation"))
+    bbox = draw.textbbox((0, 0), name, font=font)
+    x = (image.width - (bbox[2] - bbox[0])) / 2
+    draw.text((x, template["text_position"][1]), name, font=font, fill=tuple(template["font_color"]))
+    return image
+
+
+def pdf_frame(pdf):
+    # Decodes the page image of a single-image PDF, as written by either
+    # pdf_writer.build_image_pdf (Flate with PNG predictors) or Pillow (JPEG 2000)
+    start = pdf.rindex(b"/Subtype /Image")
+    entries = pdf[start : pdf.index(b"stream\n", start)]
+    length = int(re.search(rb"/Length (\d+)", entries).group(1))
+    data_start = pdf.index(b"stream\n", start) + len(b"stream\n")
+    stream = pdf[data_start : data_start + length]
+    if b"/JPXDecode" in entries:
+        return Image.open(io.BytesIO(stream))
+    width = int(re.search(rb"/Width (\d+)", entries).group(1))
+    height = int(re.search(rb"/Height (\d+)", entries).group(1))
+    colors = int(re.search(rb"/Colors (\d+)", entries).group(1))
+
+    def chunk(kind, payload):
+        return struct.pack(">I", len(payload)) + kind + payload + struct.pack(">I", zlib.crc32(kind + payload))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 0 if colors == 1 else 2, 0, 0, 0)
+    png = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", stream) + chunk(b"IEND", b"")
+    return Image.open(io.BytesIO(png))
+
+
+def pixel_cases(config, config_dir, workdir):
+    # The configured templates, plus a grayscale and a transparent variant of the first one
+    cases = []
+    for group, template in sorted(config["templates"].items()):
+        case = dict(template, render_mode="raster")
+        case["template_path"] = os.path.join(config_dir, template["template_path"])
+        case["font_path"] = os.path.join(config_dir, template["font_path"])
+        cases.append((group, case))
+    base = cases[0][1]
+    with Image.open(base["template_path"]) as source:
+        gray = dict(base, template_path=os.path.join(workdir, "gray.png"), font_color=[40, 40, 40])
+        source.convert("L").save(gray["template_path"])
+        transparent = dict(base, template_path=os.path.join(workdir, "transparent.png"))
+        rgba = source.convert("RGBA")
+        rgba.putalpha(Image.linear_gradient("L").resize(rgba.size))
+        rgba.save(transparent["template_path"])
+    cases += [("gray", gray), ("alpha", transparent)]
+    return cases
+
+
+def cmd_pixels(args):
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    config_dir = os.path.dirname(os.path.abspath(args.config))
+    names = ["Ada Lovelace", "Øyvind Ål-Ñúñez", "Jo", "Wolfgang Amadeus Mozart-Württemberg"]
+    mismatches = 0
+
+    print(f"{'template':<10} {'mode':<5} {'frame MB':>9} {'legacy MB':>10} {'encode ms':>10} {'legacy ms':>10}  pixels")
+    with tempfile.TemporaryDirectory() as workdir:
+        for label, template in pixel_cases(config, config_dir, workdir):
+            mode = mailer.pixel_mode(template)
+            encode = legacy_encode = 0.0
+            same = True
+            for name in names:
+                with collect_timings() as timings:
+                    pdf = mailer.render_certificate(name, template)
+                encode += timings["render.encode"]
+                expected = legacy_frame(name, template)
+                start = time.perf_counter()
+                expected.save(io.BytesIO(), format="PDF")
+                legacy_encode += time.perf_counter() - start
+                # PDF viewers drop alpha either way; compare what ends up on the page
+                if pdf_frame(pdf).convert("RGB").tobytes() != expected.convert("RGB").tobytes():
+                    same = False
+            mismatches += not same
+            width, height = expected.size
+            print(
+                f"{label:<10} {mode:<5} {width * height * len(mode) / 2**20:9.1f} {width * height * 4 / 2**20:10.1f}"
+                f" {encode / len(names) * 1000:10.1f} {legacy_encode / len(names) * 1000:10.1f}"
+                f"  {'identical' if same else 'DIFFERENT'}"
+            )
+    if mismatches:
+        sys.exit(f"{mismatches} template(s) render differently from the RGBA path")
+
+
+# (label, output_format, output_options) rows compared by the formats benchmark
+FORMAT_PRESETS = [
+    ("pdf flate", "pdf", {}),
+    ("jpeg q85", "jpeg", {"quality": 85, "optimize": True, "progressive": True}),
+    ("jpeg q95", "jpeg", {"quality": 95}),
+    ("png 6", "png", {"compress_level": 6}),
+    ("png 9 opt", "png", {"compress_level": 9, "optimize": True}),
+    ("webp q85", "webp", {"quality": 85}),
+    ("webp lossless", "webp", {"lossless": True}),
+    ("avif q60", "avif", {"quality": 60}),
+]
+
+
+def cmd_formats(args):
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    config_dir = os.path.dirname(os.path.abspath(args.config))
+
+    print(f"{args.repeat} renders per row; times are means per certificate\n")
+    print(f"{'template':<10} {'format':<14} {'mode':<5} {'encode ms':>10} {'KB':>8}")
+    for group, template in sorted(config["templates"].items()):
+        template = dict(template, render_mode="raster")
+        template["template_path"] = os.path.join(config_dir, template["template_path"])
+        template["font_path"] = os.path.join(config_dir, template["font_path"])
+        presets = list(FORMAT_PRESETS)
+        configured = (mailer.output_format(template), template.get("output_options", {}))
+        if configured not in [(fmt, options) for _, fmt, options in presets]:
+            presets.append(("configured", *configured))
+        for label, fmt, options in presets:
+            case = dict(template, output_format=fmt, output_options=options)
+            mailer.render_certificate("Warm Up", case)
+            encode = size = 0
+            for i in range(args.repeat):
+                with collect_timings() as timings:
+                    data = mailer.render_certificate(f"Recipient Number {i}", case)
+                encode += timings["render.encode"]
+                size += len(data)
+            print(
+                f"{group:<10} {label:<14} {mailer.pixel_mode(case, fmt):<5}"
+                f" {encode / args.repeat * 1000:10.1f} {size / args.repeat / 1024:8.1f}"
+            )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Certificate Mailer benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    transport = commands.add_parser("transport", help="messages/sec of the sync and async SMTP engines")
+    transport.add_argument("--messages", type=int, default=2000)
+    transport.add_argument("--attachment-kb", type=int, default=64)
+    transport.add_argument("--latency", type=float, default=0.02, help="sink delay before acknowledging DATA")
+    transport.add_argument("--sync-connections", type=int, default=8)
+    transport.add_argument("--async-connections", type=int, default=200)
+    transport.set_defaults(func=cmd_transport)
+
+    e2e = commands.add_parser("e2e", help="run the whole mailer against a local sink with synthetic recipients")
+    e2e.add_argument("--config", default="config.json")
+    e2e.add_argument("--recipients", type=int, default=500)
+    e2e.add_argument("--render-workers", type=int, default=1)
+    e2e.add_argument("--render-mode", choices=["raster", "native", "band", "composite"])
+    e2e.add_argument("--transport", choices=["sync", "async"], default="sync")
+    e2e.add_argument("--connections", type=int, default=4)
+    e2e.add_argument("--archive", action="store_true", help="also write certificates to disk")
+    e2e.add_argument("--latency", type=float, default=0.01)
+    e2e.add_argument("--throttle-rate", type=float, default=0.0)
+    e2e.add_argument("--disconnect-rate", type=float, default=0.0)
+    e2e.add_argument("--verify", action="store_true", help="have the sink parse and check every message")
+    e2e.add_argument("--metrics-json", help="also write the run's metrics report here")
+    e2e.set_defaults(func=cmd_e2e)
+
+    compositing = commands.add_parser(
+        "compositing", help="full-frame raster drawing vs in-place mask compositing at several template resolutions"
+    )
+    compositing.add_argument("--config", default="config.json")
+    compositing.add_argument("--group", help="template to use (default: the first one)")
+    compositing.add_argument("--scales", type=int, nargs="+", default=[1, 2, 4])
+    compositing.add_argument("--repeat", type=int, default=3)
+    compositing.set_defaults(func=cmd_compositing)
+
+    pixels = commands.add_parser(
+        "pixels", help="check that per-format pixel modes put the same pixels on the page as the RGBA path"
+    )
+    pixels.add_argument("--config", default="config.json")
+    pixels.set_defaults(func=cmd_pixels)
+
+    formats = commands.add_parser("formats", help="encode time and file size of each output format per template")
+    formats.add_argument("--config", default="config.json")
+    formats.add_argument("--repeat", type=int, default=3)
+    formats.set_defaults(func=cmd_formats)
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
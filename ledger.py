@@ -0,0 +1,136 @@
+import csv
+import hashlib
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recipients (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    updated REAL NOT NULL
+)
+"""
+
+UPSERT = """
+INSERT INTO recipients (key, name, email, grp, state, error, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(key) DO UPDATE SET
+    state = excluded.state, error = excluded.error, updated = excluded.updated
+WHERE recipients.state != 'sent'
+"""
+
+
+def recipient_key(name, email, group):
+    identity = "\0".join((email.strip().lower(), group.strip(), name.strip()))
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+def shard_of(email, count):
+    # Stable across hosts and Python versions, unlike hash()
+    digest = hashlib.sha256(email.strip().lower().encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+class RunLedger:
+    # Writes are buffered and committed by one writer thread, either when
+    # batch_size records are pending or every flush_interval seconds
+    def __init__(self, path, batch_size=200, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(SCHEMA)
+        self._conn.commit()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def state(self, key):
+        with self._db_lock:
+            row = self._conn.execute("SELECT state FROM recipients WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def counts(self):
+        with self._db_lock:
+            return dict(self._conn.execute("SELECT state, COUNT(*) FROM recipients GROUP BY state").fetchall())
+
+    def sent_since(self, timestamp):
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM recipients WHERE state = 'sent' AND updated >= ?", (timestamp,)
+            ).fetchone()
+        return row[0]
+
+    def mark(self, key, name, email, group, state, error=None):
+        with self._lock:
+            self._pending.append((key, name, email, group, state, error, time.time()))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if batch:
+            with self._db_lock, self._conn:
+                self._conn.executemany(UPSERT, batch)
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+        self._conn.close()
+
+    def _write_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+class DeadLetterReport:
+    # Same columns as the input CSV, so the report can be fed back in as input
+    FIELDS = ["name", "email", "piORth", "stage", "kind", "error"]
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def add(self, name, email, group, stage, kind, error):
+        with self._lock:
+            if self._writer is None:
+                self._file = open(self.path, "w", newline="", encoding="utf-8")
+                self._writer = csv.DictWriter(self._file, fieldnames=self.FIELDS)
+                self._writer.writeheader()
+            self._writer.writerow(
+                {"name": name, "email": email, "piORth": group, "stage": stage, "kind": kind, "error": str(error)}
+            )
+            self._file.flush()
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
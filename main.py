@@ -1,56 +1,782 @@
+import argparse
 import csv
+import io
+import marshal
+import math
+import mmap
 import os
 import json
 import smtplib
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from multiprocessing import shared_memory
 from email.message import EmailMessage
 from PIL import Image, ImageDraw, ImageFont
 
+import pdf_writer
+from ledger import DeadLetterReport, RunLedger, recipient_key, shard_of
+from pipeline import RetryQueue, Stage
+from render_cache import RenderCache, file_digest
+from smtp import DailyLimitReached, RateLimiter, SMTPSession, make_pool, smtp_code
+from timing import LatencyStats, Metrics, Profiler, collect_timings, sample_profile, timed
+from work_queue import WorkQueue
 
-def load_config():
-    with open("config.json", "r") as f:
+
+def mappable_mode(mode):
+    # Image.frombuffer only wraps memory in place for some modes and silently
+    # copies the rest, so RGB pixels are kept padded to RGBX wherever they are
+    # mapped; L and RGBA map as they are
+    return "RGBX" if mode == "RGB" else mode
+
+
+class TemplateStore:
+    # Decoded template pixels kept on disk as raw RGBX, L or RGBA, one file per
+    # pixel mode, named after the hash of the source file and the mode
+    # (<hash>-RGBX-...). A cold process memory-maps them instead of decoding
+    # the JPEG, and editing the JPEG changes the hash, so stale pixels are
+    # never read. Least recently used files go once the store exceeds max_bytes.
+    def __init__(self, path=None, max_bytes=2 * 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def load(self, template_path, mode="RGBA"):
+        # Returns the template in mappable_mode(mode)
+        stored = mappable_mode(mode)
+        with Image.open(template_path) as source:
+            size = source.size
+        filename = os.path.join(self.path, f"{file_digest(template_path)}-{stored}-{size[0]}x{size[1]}.raw")
+        try:
+            with open(filename, "rb") as f:
+                pixels = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(filename)
+            return Image.frombuffer(stored, size, pixels, "raw", stored, 0, 1)
+        except (OSError, ValueError):
+            # Missing, or truncated by a crash: decode and write it again
+            pass
+
+        with Image.open(template_path) as source:
+            image = source.convert(mode)
+        if stored != mode:
+            image = image.convert(stored)
+        image.load()
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(image.tobytes())
+            os.replace(tmp, filename)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._evict(keep=filename)
+        return image
+
+    def _evict(self, keep):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".raw") and entry.path != keep:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+            total = sum(size for _, _, size in entries) + os.path.getsize(keep)
+            for _, path, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+template_store = TemplateStore()
+
+
+def decode_template(template_path, mode="RGBA"):
+    if template_store.path:
+        return template_store.load(template_path, mode)
+    with Image.open(template_path) as source:
+        image = source.convert(mode)
+    image.load()
+    return image
+
+
+# Output formats that can carry an alpha channel. PDFs keep the RGBA path
+# Pillow has always used for them, so transparent templates look the same.
+ALPHA_FORMATS = {"pdf", "png", "webp", "avif"}
+
+
+@lru_cache(maxsize=64)
+def _pixel_mode(template_path, mtime, font_color, output_format):
+    with Image.open(template_path) as source:
+        transparent = source.mode in ("RGBA", "LA", "PA") or "transparency" in source.info
+        gray = source.mode in ("1", "L", "LA", "I", "F")
+    if transparent and output_format in ALPHA_FORMATS:
+        return "RGBA"
+    if gray and font_color[0] == font_color[1] == font_color[2]:
+        return "L"
+    return "RGB"
+
+
+def pixel_mode(template_config, output_format="pdf"):
+    # Smallest mode that still holds every pixel the output keeps: L for gray
+    # templates with gray text, RGBA only when the template is transparent and
+    # the format stores alpha, RGB otherwise
+    template_path = template_config["template_path"]
+    return _pixel_mode(
+        os.path.abspath(template_path),
+        os.path.getmtime(template_path),
+        tuple(template_config["font_color"][:3]),
+        output_format,
+    )
+
+
+def template_mode(template_config):
+    # The mode render_certificate will ask the template cache for
+    render_mode = template_config.get("render_mode", "raster")
+    if render_mode == "native":
+        return None
+    if render_mode in ("band", "composite"):
+        return "RGB"
+    return pixel_mode(template_config, output_format(template_config))
+
+
+class TemplateCache:
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._shared = {}
+        self._segments = []
+        self._lock = threading.Lock()
+
+    def get(self, template_path, mode="RGBA"):
+        # Templates mapped from the store or shared memory come back in
+        # mappable_mode(mode); copy() hands out exactly mode
+        key = (os.path.abspath(template_path), mode)
+        mtime = os.path.getmtime(template_path)
+        shared = self._shared.get(key)
+        if shared is not None and shared[0] == mtime:
+            return shared[1]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(key)
+                return entry[1]
+            if entry is not None:
+                self._drop(key)
+
+        image = decode_template(template_path, mode)
+        nbytes = image.width * image.height * len(image.getbands())
+
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (mtime, image, nbytes)
+            self.size += nbytes
+            # Always keep the newest entry, even if it alone exceeds the bound
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                self._drop(next(iter(self._entries)))
+        return image
+
+    def copy(self, template_path, mode="RGBA"):
+        image = self.get(template_path, mode)
+        # The private per-recipient buffer is allocated either way, so dropping RGBX padding costs no extra copy
+        return image.copy() if image.mode == mode else image.convert(mode)
+
+    def attach(self, descriptors):
+        # Maps the templates a SharedTemplates placed in shared memory. The
+        # images are read-only views of the segments, outside of max_bytes;
+        # copy() still gives each recipient a private buffer.
+        for (path, mode), (segment_name, mtime, size) in descriptors.items():
+            segment = shared_memory.SharedMemory(name=segment_name)
+            self._segments.append(segment)
+            shared_mode = mappable_mode(mode)
+            self._shared[path, mode] = (
+                mtime,
+                Image.frombuffer(shared_mode, size, segment.buf, "raw", shared_mode, 0, 1),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _drop(self, key):
+        _, _, nbytes = self._entries.pop(key)
+        self.size -= nbytes
+
+
+template_cache = TemplateCache()
+
+
+class SharedTemplates:
+    # Decodes each template once in the parent and puts the pixels in shared
+    # memory, so render workers map them instead of holding a decoded copy
+    # each. templates yields template configs.
+    def __init__(self, templates):
+        self.descriptors = {}
+        self._segments = []
+        for template_config in templates:
+            try:
+                mode = template_mode(template_config)
+                if mode is None:
+                    # Native PDFs embed the JPEG as is
+                    continue
+                path = os.path.abspath(template_config["template_path"])
+                if (path, mode) in self.descriptors:
+                    continue
+                mtime = os.path.getmtime(path)
+                image = decode_template(path, mode)
+                if image.mode != mappable_mode(mode):
+                    image = image.convert(mappable_mode(mode))
+            except (OSError, ValueError):
+                # Recipients of a missing template or an unknown output_format
+                # fail in the worker, with the usual message
+                continue
+            data = image.tobytes()
+            segment = shared_memory.SharedMemory(create=True, size=len(data))
+            segment.buf[: len(data)] = data
+            self._segments.append(segment)
+            self.descriptors[path, mode] = (segment.name, mtime, image.size)
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+
+
+class FontRegistry:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    def get(self, font_path, font_size, variation=None):
+        if isinstance(variation, list):
+            variation = tuple(variation)
+        key = (os.path.abspath(font_path), font_size, variation)
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is not None:
+                self.hits += 1
+                return font
+            self.misses += 1
+
+        font = ImageFont.truetype(font_path, font_size)
+        if isinstance(variation, str):
+            font.set_variation_by_name(variation)
+        elif variation is not None:
+            font.set_variation_by_axes(list(variation))
+
+        with self._lock:
+            return self._fonts.setdefault(key, font)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "fonts": len(self._fonts)}
+
+
+font_registry = FontRegistry()
+
+
+TRANSIENT, PERMANENT = "transient", "permanent"
+
+
+def classify_error(error, stage="send"):
+    if stage != "send":
+        # Rendering is deterministic: only resource exhaustion is worth another try
+        return TRANSIENT if isinstance(error, (MemoryError, BrokenProcessPool)) else PERMANENT
+    if isinstance(error, DailyLimitReached):
+        return PERMANENT
+    code = smtp_code(error)
+    if code is not None:
+        return TRANSIENT if 400 <= code < 500 else PERMANENT
+    if isinstance(error, (smtplib.SMTPServerDisconnected, OSError)):
+        return TRANSIENT
+    return PERMANENT
+
+
+def load_config(path="config.json"):
+    with open(path, "r") as f:
         return json.load(f)
 
 
-def load_recipients(csv_file):
-    recipients = []
+def iter_recipients(csv_file):
+    # Yields (row_number, row) lazily so only the rows in flight are held in memory
     with open(csv_file, "r", newline="", encoding="utf-8") as f:
         reader = csv.DictReader(f)
-        for row in reader:
+        for row_number, row in enumerate(reader, start=1):
             if not row.get("name") or not row.get("email") or not row.get("piORth"):
-                print("⚠️ Skipping a row: missing one of 'name', 'email', 'piORth'.")
+                print(f"⚠️ Skipping row {row_number}: missing one of 'name', 'email', 'piORth'.")
                 continue
-            recipients.append(row)
-    return recipients
+            yield row_number, row
 
 
-def write_text_on_image(name, template_config, output_folder):
+def count_recipients(csv_file):
+    # Cheap pre-pass for progress display: counts data rows without building dicts
+    with open(csv_file, "r", newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return sum(1 for row in reader if row)
+
+
+def load_recipients(csv_file):
+    return [row for _, row in iter_recipients(csv_file)]
+
+
+def in_shard(email, shard):
+    # shard is (index, count) with 0 <= index < count; None selects everyone.
+    # Hashing the address keeps a recipient on the same shard when rows are
+    # added, removed or reordered.
+    return shard is None or shard_of(email, shard[1]) == shard[0]
+
+
+def shard_path(path, shard):
+    # ledger.sqlite3 -> ledger.shard-0-of-4.sqlite3, so shards never share a file
+    if shard is None:
+        return path
+    return suffixed_path(path, f"shard-{shard[0]}-of-{shard[1]}")
+
+
+def suffixed_path(path, suffix):
+    if not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{suffix}{ext}"
+
+
+def render_native_pdf(name, template_config):
+    if template_config.get("font_variation") is not None:
+        raise ValueError("render_mode 'native' does not support font_variation")
+
+    with timed("render.template"):
+        jpeg = pdf_writer.load_jpeg(template_config["template_path"])
+        ttf = pdf_writer.load_font(template_config["font_path"])
+        font = font_registry.get(template_config["font_path"], template_config["font_size"])
+
+    # Same centering and anchor as write_text_on_image: the top of the ascender sits at y
+    with timed("render.layout"):
+        bbox = font.getbbox(name)
+        x = (jpeg.width - (bbox[2] - bbox[0])) / 2
+        baseline = template_config["text_position"][1] + font.getmetrics()[0]
+
+    with timed("render.encode"):
+        return pdf_writer.build_certificate_pdf(
+            jpeg, ttf, name, template_config["font_size"], template_config["font_color"], x, baseline
+        )
+
+
+def _adler32_combine(adler1, adler2, len2):
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xFFFF
+    sum2 = (rem * sum1 + (adler1 >> 16) + (adler2 >> 16) + base - rem) % base
+    sum1 = (sum1 + (adler2 & 0xFFFF) + base - 1) % base
+    return sum1 | (sum2 << 16)
+
+
+def _png_idat(image, level):
+    # The zlib stream inside a PNG, which PDF reads as FlateDecode with /Predictor 15
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=level)
+    data = buffer.getvalue()
+    pos, idat = 8, []
+    while pos < len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos : pos + 8])
+        if chunk_type == b"IDAT":
+            idat.append(data[pos + 8 : pos + 8 + length])
+        pos += 12 + length
+    return b"".join(idat)
+
+
+def _png_filtered_rows(image):
+    # Let Pillow pick the PNG row filters, then unwrap the IDAT payload
+    return zlib.decompress(_png_idat(image, 0))
+
+
+def _deflate(data, level, final):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class BandTemplate:
+    # Everything above and below the name band is filtered and deflated once;
+    # each recipient only deflates the band rows and the pieces are spliced
+    # into one zlib stream (PNG predictors, as PDF /Predictor 15 expects).
+    def __init__(self, image, top, bottom, level):
+        self.width, self.height = image.size
+        self.top, self.bottom = top, bottom
+        self.level = level
+        # image may be a mapped RGBX template; the crops are private RGB copies
+        self.band = image.crop((0, top, self.width, bottom)).convert("RGB")
+        stride = 1 + self.width * 3
+
+        top_rows = _png_filtered_rows(image.crop((0, 0, self.width, top)).convert("RGB")) if top else b""
+        # The first bottom row is filtered against the last band row, which
+        # render_band_pdf guarantees is never drawn on
+        bottom_rows = b""
+        if bottom < self.height:
+            bottom_rows = _png_filtered_rows(image.crop((0, bottom - 1, self.width, self.height)).convert("RGB"))[stride:]
+
+        self.top_data = _deflate(top_rows, level, False) if top_rows else b""
+        self.bottom_data = _deflate(bottom_rows, level, True) if bottom_rows else b""
+        self.top_adler = zlib.adler32(top_rows)
+        self.bottom_adler = zlib.adler32(bottom_rows)
+        self.bottom_length = len(bottom_rows)
+
+    def encode(self, band):
+        raw = band.tobytes()
+        stride = self.width * 3
+        rows = b"".join(b"\0" + raw[i : i + stride] for i in range(0, len(raw), stride))
+        adler = _adler32_combine(self.top_adler, zlib.adler32(rows), len(rows))
+        adler = _adler32_combine(adler, self.bottom_adler, self.bottom_length)
+        band_data = _deflate(rows, self.level, not self.bottom_data)
+        return b"\x78\x9c" + self.top_data + band_data + self.bottom_data + struct.pack(">I", adler)
+
+
+@lru_cache(maxsize=16)
+def _band_template(template_path, mtime, top, bottom, level):
+    image = template_cache.get(template_path, "RGB")
+    return BandTemplate(image, top, bottom, level)
+
+
+def render_band_pdf(name, template_config):
+    template_path = template_config["template_path"]
+    font = font_registry.get(template_config["font_path"], template_config["font_size"], template_config.get("font_variation"))
+    width, height = template_cache.get(template_path, "RGB").size
+    y = template_config["text_position"][1]
+    ascent, descent = font.getmetrics()
+    pad = template_config["font_size"] // 2
+    top = max(0, y - pad)
+    bottom = min(height, y + ascent + descent + pad)
+
+    bbox = font.getbbox(name)
+    x = (width - (bbox[2] - bbox[0])) / 2
+    # Glyphs reaching outside the band (or into its last row) need the full render
+    if y + bbox[1] < top or y + bbox[3] > bottom - 1:
+        return render_raster(name, template_config)
+
+    level = template_config.get("band_compress_level", 6)
+    with timed("render.template"):
+        band_template = _band_template(os.path.abspath(template_path), os.path.getmtime(template_path), top, bottom, level)
+        band = band_template.band.copy()
+    with timed("render.draw"):
+        ImageDraw.Draw(band).text((x, y - top), name, font=font, fill=tuple(template_config["font_color"]))
+
+    with timed("render.encode"):
+        return pdf_writer.build_image_pdf(
+            width,
+            height,
+            band_template.encode(band),
+            b"/ColorSpace /DeviceRGB /Filter /FlateDecode"
+            b" /DecodeParms << /Predictor 15 /Colors 3 /BitsPerComponent 8 /Columns %d >>" % width,
+        )
+
+
+# Pillow encoder options each format accepts in a template's output_options
+OUTPUT_FORMATS = {
+    "pdf": {"pillow": "PDF", "extension": "pdf", "mime": "application/pdf", "options": {"compress_level"}},
+    "jpeg": {
+        "pillow": "JPEG",
+        "extension": "jpg",
+        "mime": "image/jpeg",
+        "options": {"quality", "optimize", "progressive", "subsampling"},
+    },
+    "png": {"pillow": "PNG", "extension": "png", "mime": "image/png", "options": {"compress_level", "optimize"}},
+    "webp": {"pillow": "WEBP", "extension": "webp", "mime": "image/webp", "options": {"quality", "method", "lossless"}},
+    "avif": {"pillow": "AVIF", "extension": "avif", "mime": "image/avif", "options": {"quality", "speed", "subsampling"}},
+}
+
+
+def output_format(template_config):
+    fmt = (template_config or {}).get("output_format", "pdf").lower()
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output_format: {fmt}")
+    return fmt
+
+
+def encode_frame(image, template_config, default_level=6):
+    # Encodes a finished certificate in the template's output_format
+    fmt = output_format(template_config)
+    options = template_config.get("output_options", {})
+    unknown = set(options) - OUTPUT_FORMATS[fmt]["options"]
+    if unknown:
+        raise ValueError(f"Unsupported {fmt} output_options: {', '.join(sorted(unknown))}")
+    if fmt == "pdf" and image.mode != "RGBA":
+        return _flate_image_pdf(image, options.get("compress_level", default_level))
+    buffer = io.BytesIO()
+    image.save(buffer, format=OUTPUT_FORMATS[fmt]["pillow"], **options)
+    return buffer.getvalue()
+
+
+def _flate_image_pdf(image, level):
+    # Lossless PDF of an RGB or L frame, reusing the PNG encoder's zlib stream
+    colors, color_space = (1, b"/DeviceGray") if image.mode == "L" else (3, b"/DeviceRGB")
+    return pdf_writer.build_image_pdf(
+        image.width,
+        image.height,
+        _png_idat(image, level),
+        b"/ColorSpace %s /Filter /FlateDecode /DecodeParms << /Predictor 15 /Colors %d /BitsPerComponent 8 /Columns %d >>"
+        % (color_space, colors, image.width),
+    )
+
+
+_composite_buffers = threading.local()
+
+
+def _composite_buffer(template_path):
+    # One RGB copy of each template per thread; recipients are drawn on it in
+    # place and the touched pixels put back afterwards
+    key = os.path.abspath(template_path)
+    mtime = os.path.getmtime(template_path)
+    buffers = getattr(_composite_buffers, "buffers", None)
+    if buffers is None:
+        buffers = _composite_buffers.buffers = {}
+    entry = buffers.get(key)
+    if entry is None or entry[0] != mtime:
+        entry = buffers[key] = (mtime, template_cache.copy(template_path, "RGB"))
+    return entry[1]
+
+
+def text_mask(draw, xy, text, font):
+    # Renders only the glyphs: an L mask the size of the ink box, and where
+    # that box sits on the image behind draw. Compositing the mask with
+    # paste() gives the same pixels as draw.text at xy.
+    left, top, right, bottom = draw.textbbox(xy, text, font=font)
+    left, top, right, bottom = math.floor(left), math.floor(top), math.ceil(right), math.ceil(bottom)
+    mask = Image.new("L", (right - left, bottom - top))
+    ImageDraw.Draw(mask).text((xy[0] - left, xy[1] - top), text, font=font, fill=255)
+    return mask, (left, top)
+
+
+def render_composite(name, template_config):
+    template_path = template_config["template_path"]
+    font = font_registry.get(template_config["font_path"], template_config["font_size"], template_config.get("font_variation"))
+    with timed("render.template"):
+        image = _composite_buffer(template_path)
+
+    with timed("render.draw"):
+        draw = ImageDraw.Draw(image)
+        # Same centering as render_raster
+        bbox = draw.textbbox((0, 0), name, font=font)
+        x = (image.width - (bbox[2] - bbox[0])) / 2
+        mask, (left, top) = text_mask(draw, (x, template_config["text_position"][1]), name, font)
+        box = (left, top, left + mask.width, top + mask.height)
+        saved = image.crop(box)
+        image.paste(tuple(template_config["font_color"][:3]), box, mask)
+
+    try:
+        with timed("render.encode"):
+            return encode_frame(image, template_config, template_config.get("composite_compress_level", 6))
+    finally:
+        image.paste(saved, box)
+
+
+def render_certificate(name, template_config):
     template_path = template_config["template_path"]
     if not os.path.exists(template_path):
         raise FileNotFoundError(f"Template not found: {template_path}")
 
-    image = Image.open(template_path).convert("RGBA")
+    render_mode = template_config.get("render_mode", "raster")
+    if render_mode in ("native", "band") and output_format(template_config) != "pdf":
+        raise ValueError(f"render_mode {render_mode} only produces PDF; use raster or composite for other formats")
+    if render_mode == "native":
+        return render_native_pdf(name, template_config)
+    if render_mode == "band":
+        return render_band_pdf(name, template_config)
+    if render_mode == "composite":
+        return render_composite(name, template_config)
+    if render_mode != "raster":
+        raise ValueError(f"Unknown render_mode: {render_mode}")
+    return render_raster(name, template_config)
+
+
+def render_raster(name, template_config):
+    template_path = template_config["template_path"]
+    with timed("render.template"):
+        image = template_cache.copy(template_path, pixel_mode(template_config, output_format(template_config)))
     draw = ImageDraw.Draw(image)
 
     font_path = template_config["font_path"]
-    font = ImageFont.truetype(font_path, template_config["font_size"])
+    font = font_registry.get(font_path, template_config["font_size"], template_config.get("font_variation"))
 
     text_color = tuple(template_config["font_color"])
+    if image.mode == "L":
+        text_color = text_color[0]
     y = template_config["text_position"][1]
 
-    # Center text horizontally
-    bbox = draw.textbbox((0, 0), name, font=font)
-    text_width = bbox[2] - bbox[0]
-    x = (image.width - text_width) / 2
+    with timed("render.draw"):
+        # Center text horizontally
+        bbox = draw.textbbox((0, 0), name, font=font)
+        text_width = bbox[2] - bbox[0]
+        x = (image.width - text_width) / 2
+
+        draw.text((x, y), name, font=font, fill=text_color)
+
+    with timed("render.encode"):
+        return encode_frame(image, template_config, template_config.get("raster_compress_level", 6))
+
+
+def certificate_filename(name, template_config=None):
+    return f"{name}.{OUTPUT_FORMATS[output_format(template_config)]['extension']}"
+
+
+def read_certificates(jobs, folder):
+    # Same contract as render_certificates, for certificates rendered by an earlier run
+    for job in jobs:
+        try:
+            yield job, _read_file(os.path.join(folder, certificate_filename(job[1], job[3]))), None
+        except (OSError, ValueError) as e:
+            yield job, None, e
 
-    draw.text((x, y), name, font=font, fill=text_color)
 
+def save_certificate(data, filename, output_folder):
     os.makedirs(output_folder, exist_ok=True)
-    output_file = os.path.join(output_folder, f"{name}.pdf")
-    image.save(output_file)
+    output_file = os.path.join(output_folder, filename)
+    with open(output_file, "wb") as f:
+        f.write(data)
     return output_file
 
 
-def send_email(recipient_name, recipient_email, output_file, template_config, email_settings):
+def write_text_on_image(name, template_config, output_folder):
+    data = render_certificate(name, template_config)
+    return save_certificate(data, certificate_filename(name, template_config), output_folder)
+
+
+def _init_render_worker(template_cache_bytes, template_store_path, shared_templates):
+    template_cache.max_bytes = template_cache_bytes
+    template_store.path = template_store_path
+    template_cache.attach(shared_templates)
+
+
+def _render_job(name, template_config, profile=False):
+    # Runs in the render worker; timings and the optional profile travel back with the bytes
+    with collect_timings() as timings, sample_profile(profile) as profiler:
+        data = render_certificate(name, template_config)
+    dump = marshal.dumps(profiler.stats) if profiler is not None else None
+    return data, timings, dump
+
+
+def render_certificates(jobs, workers=1, metrics=None, profiler=None, cache=None, shared=None, retries=0):
+    # jobs yields (idx, name, email, template_config, ...); results are PDF bytes in completion order.
+    # Transient failures (a dead worker, MemoryError) are rendered again up to `retries` times.
+    profiler = profiler or Profiler()
+
+    def cached(job):
+        # (key, data), data being None on a miss; a missing template fails later, in the render
+        if cache is None:
+            return None, None
+        try:
+            key = cache.key(job[1], job[3])
+        except OSError:
+            return None, None
+        return key, cache.get(key)
+
+    def finish(result, key):
+        data, timings, dump = result
+        if metrics is not None:
+            metrics.merge(timings)
+        if dump is not None:
+            profiler.add(dump)
+        if key is not None:
+            cache.put(key, data)
+        return data
+
+    if workers <= 1:
+        for job in jobs:
+            key, data = cached(job)
+            if data is not None:
+                yield job, data, None
+                continue
+            for attempt in range(retries + 1):
+                try:
+                    data, error = finish(_render_job(job[1], job[3], profiler.wants(job[0])), key), None
+                    break
+                except Exception as e:
+                    error = e
+                    if classify_error(e, "render") != TRANSIENT:
+                        break
+            yield job, data, error
+        return
+
+    def start_pool():
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_render_worker,
+            initargs=(template_cache.max_bytes, template_store.path, shared.descriptors if shared is not None else {}),
+        )
+
+    jobs = iter(jobs)
+    pending = {}
+    # (job, key, attempts) to submit before taking new jobs: refused submits and transient failures
+    again = deque()
+    exhausted = False
+    broken = False
+    executor = start_pool()
+    try:
+        while True:
+            while len(pending) < workers * 4:
+                # A retried job runs alone: if it kills its worker again, it takes no other job down with it
+                if any(attempts for _, _, attempts in pending.values()):
+                    break
+                if again:
+                    if again[0][2] and pending:
+                        break
+                    job, key, attempts = again.popleft()
+                elif exhausted:
+                    break
+                else:
+                    job = next(jobs, None)
+                    if job is None:
+                        exhausted = True
+                        break
+                    key, data = cached(job)
+                    if data is not None:
+                        yield job, data, None
+                        continue
+                    attempts = 0
+                try:
+                    future = executor.submit(_render_job, job[1], job[3], profiler.wants(job[0]))
+                except BrokenProcessPool:
+                    # A worker died; this job never ran, so it goes to the replacement pool
+                    again.appendleft((job, key, attempts))
+                    broken = True
+                    break
+                pending[future] = job, key, attempts
+            if pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, key, attempts = pending.pop(future)
+                    error = future.exception()
+                    broken = broken or isinstance(error, BrokenProcessPool)
+                    if error is not None and classify_error(error, "render") == TRANSIENT and attempts < retries:
+                        again.append((job, key, attempts + 1))
+                        continue
+                    yield job, None if error else finish(future.result(), key), error
+            elif not broken and not again:
+                return
+            if broken and not pending:
+                # Every job the dead pool held has failed or been queued again above; carry on with a fresh one
+                executor.shutdown(wait=False)
+                executor = start_pool()
+                broken = False
+    finally:
+        executor.shutdown()
+
+
+def build_email(recipient_name, recipient_email, attachment, filename, template_config, email_settings):
     msg = EmailMessage()
     msg["Subject"] = template_config["email_subject"]
     msg["From"] = email_settings["sender_email"]
@@ -58,67 +784,683 @@ def send_email(recipient_name, recipient_email, output_file, template_config, em
 
     msg.set_content(template_config["email_body"].format(name=recipient_name))
 
+    maintype, subtype = OUTPUT_FORMATS[output_format(template_config)]["mime"].split("/")
+    msg.add_attachment(attachment, maintype=maintype, subtype=subtype, filename=filename)
+    return msg
+
+
+def send_email(recipient_name, recipient_email, output_file, template_config, email_settings, session=None):
     with open(output_file, "rb") as f:
-        msg.add_attachment(f.read(), maintype="image", subtype="png", filename=os.path.basename(output_file))
+        attachment = f.read()
+    msg = build_email(
+        recipient_name, recipient_email, attachment, os.path.basename(output_file), template_config, email_settings
+    )
+    if session is not None:
+        session.send(msg)
+        return
+
+    with SMTPSession(email_settings) as session:
+        session.send(msg)
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/COUNT, got {value!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be in 0..{count - 1}, got {value!r}")
+    return index, count
+
 
-    with smtplib.SMTP("smtp.gmail.com", 587) as smtp:
-        smtp.starttls()
-        smtp.login(email_settings["sender_email"], email_settings["sender_password"])
-        smtp.send_message(msg)
+def _add_options(parser, defaults=True):
+    # Subcommands repeat the options with suppressed defaults so they don't
+    # overwrite values given before the subcommand name
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
 
+    parser.add_argument("--config", default=default("config.json"), help="path to the configuration file")
+    parser.add_argument("--input", default=default(None), help="recipient CSV (overrides input_csv)")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=default(None),
+        help="SMTP connections to open (overrides email_settings.connections)",
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=default(1),
+        help="number of processes rendering certificates (1 renders in-process)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=default(None),
+        metavar="INDEX/COUNT",
+        help="only process recipients whose email address hashes to shard INDEX of COUNT (0-based)",
+    )
+    parser.add_argument(
+        "-y", "--yes", action="store_true", default=default(False), help="do not ask for confirmation"
+    )
+    parser.add_argument(
+        "--profile-every",
+        type=int,
+        default=default(0),
+        help="run cProfile on every Nth recipient's render and send (0 disables profiling)",
+    )
+    parser.add_argument(
+        "--profile-output", default=default("profile.pstats"), help="where to write the merged cProfile stats"
+    )
+
+
+COMMANDS = {
+    "run": "render certificates and email them (the default)",
+    "render": "only render certificates into output_folder",
+    "send": "email certificates already rendered into output_folder",
+    "dry-run": "check the recipient list and show what a run would do, without rendering or sending",
+    "enqueue": "add the recipient list to the shared work queue",
+    "worker": "lease recipients from the work queue and render and send them until it is empty",
+}
+
+# Per-run files that get a .shard-I-of-N suffix so shards can share a directory
+SHARDED_PATHS = ("ledger_path", "dead_letter_csv", "metrics_json")
+
+PROMPTS = {
+    "run": "Proceed to generate and send certificates?",
+    "render": "Proceed to generate certificates?",
+    "send": "Proceed to send the rendered certificates?",
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Write names on certificates and email them.")
+    _add_options(parser)
+    commands = parser.add_subparsers(dest="command")
+    subparsers = {}
+    for command, help_text in COMMANDS.items():
+        subparsers[command] = commands.add_parser(command, help=help_text, description=help_text)
+        _add_options(subparsers[command], defaults=False)
+    for command in ("enqueue", "worker"):
+        subparsers[command].add_argument("--queue", help="work queue database (overrides queue_path)")
+    subparsers["worker"].add_argument(
+        "--worker-id",
+        default=f"{socket.gethostname()}-{os.getpid()}",
+        help="name this worker's leases are recorded under (default: host-pid)",
+    )
+    merge = commands.add_parser(
+        "merge", help="add up the metrics JSON files of sharded runs", description="add up the metrics JSON files of sharded runs"
+    )
+    merge.add_argument("summaries", nargs="+", help="metrics JSON written by each shard")
+    args = parser.parse_args(argv)
+    args.command = args.command or "run"
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "merge":
+        merge_summaries(args.summaries)
+        return 0
 
-def main():
     print("Certificate Mailer - starting...\n")
 
-    config = load_config()
-    recipients = load_recipients(config["input_csv"])
+    config = load_config(args.config)
+    if args.input:
+        config["input_csv"] = args.input
+    if args.concurrency:
+        config["email_settings"]["connections"] = args.concurrency
+    for key, default in zip(SHARDED_PATHS, ("ledger.sqlite3", "dead_letter.csv", "metrics.json")):
+        config[key] = shard_path(config.get(key, default), args.shard)
+    if args.command in ("enqueue", "worker") and args.queue:
+        config["queue_path"] = args.queue
+
+    if args.command == "dry-run":
+        dry_run(config, args.shard)
+        return 0
+    if args.command == "enqueue":
+        enqueue(config, args.shard)
+        return 0
+    if args.command == "worker":
+        # Workers are meant to be started by a scheduler, so they never prompt
+        summary = work(config, args.worker_id, args.render_workers, args.profile_every, args.profile_output)
+        return 1 if summary["failed"] else 0
+
+    total = count_recipients(config["input_csv"])
 
-    if not recipients:
+    if not total:
         print("No valid recipients found.")
-        return
+        return 0
 
     output_folder = config["output_folder"]
-    print(f"Recipients loaded: {len(recipients)}")
-    print(f"Output directory: {os.path.abspath(output_folder)}\n")
+    print(f"Recipient rows: {total}")
+    if args.shard:
+        print(f"Shard: {args.shard[0]}/{args.shard[1]}")
+    if args.command == "send":
+        print(f"Reading certificates from: {os.path.abspath(output_folder)}\n")
+    elif args.command == "render" or config.get("archive_output", True):
+        print(f"Output directory: {os.path.abspath(output_folder)}\n")
+    else:
+        print("Output directory: none (certificates are attached from memory)\n")
 
-    proceed = input("Proceed to generate and send certificates? (yes/no) [no]: ").strip().lower()
-    if proceed != "yes":
-        print("Aborted by user.")
-        return
+    if not args.yes:
+        proceed = input(f"{PROMPTS[args.command]} (yes/no) [no]: ").strip().lower()
+        if proceed != "yes":
+            print("Aborted by user.")
+            return 0
 
-    total = len(recipients)
-    success, failed = 0, 0
+    summary = run(
+        config,
+        args.render_workers,
+        total,
+        args.profile_every,
+        args.profile_output,
+        mode=args.command,
+        shard=args.shard,
+    )
+    return 1 if summary["failed"] else 0
 
-    for idx, recipient in enumerate(recipients, start=1):
-        name = recipient["name"].strip()
-        email = recipient["email"].strip()
-        group = recipient["piORth"].strip()
 
-        print(f"[{idx}/{total}] Processing: {name} <{email}>")
+def open_work_queue(config):
+    return WorkQueue(
+        config.get("queue_path", "queue.sqlite3"),
+        visibility_timeout=config.get("queue_visibility_seconds", 300.0),
+        max_attempts=config.get("queue_max_attempts", 5),
+    )
 
-        if group not in config["templates"]:
-            print(f"  !! Unknown group: {group}. Skipping.")
-            failed += 1
-            continue
 
-        template_cfg = config["templates"][group]
+def enqueue(config, shard=None):
+    def rows():
+        for _, recipient in iter_recipients(config["input_csv"]):
+            name = recipient["name"].strip()
+            email = recipient["email"].strip()
+            group = recipient["piORth"].strip()
+            if in_shard(email, shard):
+                yield recipient_key(name, email, group), name, email, group
 
-        try:
-            output_file = write_text_on_image(name, template_cfg, output_folder)
-            print(f"  -> Saved: {output_file}")
-            send_email(name, email, output_file, template_cfg, config["email_settings"])
-            print(f"  ✅ Sent to {email}\n")
-            success += 1
-        except Exception as e:
-            print(f"  !! Failed for {name} <{email}>: {e}\n")
-            failed += 1
+    with open_work_queue(config) as work_queue:
+        added = work_queue.enqueue(rows())
+        counts = work_queue.counts()
+    print(f"Queued {added} new recipient(s) in {os.path.abspath(config.get('queue_path', 'queue.sqlite3'))}")
+    print(", ".join(f"{state}: {n}" for state, n in sorted(counts.items())))
+    return added
+
+
+def work(config, owner, render_workers=1, profile_every=0, profile_output="profile.pstats"):
+    # Runs the normal pipeline over rows leased from the work queue. Leases are
+    # renewed while this process is alive, so only a dead or hung worker's rows
+    # go back to the queue when visibility_timeout runs out.
+    work_queue = open_work_queue(config)
+    lease_size = config.get("queue_lease_size", 50)
+    poll_seconds = min(5.0, work_queue.visibility_timeout / 10)
+    for key in ("dead_letter_csv", "metrics_json"):
+        config[key] = suffixed_path(config.get(key), f"worker-{owner}")
+    stopped = threading.Event()
+    # Set once the sender's daily budget runs out; leasing more would only defer them again
+    budget_spent = threading.Event()
+    # Rows leased but not finished. The next batch is leased only once this
+    # drops to lease_size, so a fast worker cannot hoard the queue in its
+    # pipeline buffers while slower workers sit idle.
+    outstanding = 0
+    drained = threading.Condition()
+
+    def renew_leases():
+        while not stopped.wait(work_queue.visibility_timeout / 3):
+            work_queue.renew(owner)
+
+    def leased():
+        nonlocal outstanding
+        while True:
+            with drained:
+                drained.wait_for(lambda: outstanding <= lease_size)
+            if budget_spent.is_set():
+                return
+            rows = work_queue.lease(owner, lease_size)
+            with drained:
+                outstanding += len(rows)
+            for job_id, _, name, email, group in rows:
+                yield job_id, {"name": name, "email": email, "piORth": group}
+            if rows:
+                continue
+            # Keep polling while other workers hold leases: if one dies, its rows come back here
+            if not work_queue.pending(exclude_owner=owner):
+                return
+            time.sleep(poll_seconds)
+
+    def finished(key, outcome):
+        nonlocal outstanding
+        if outcome == "deferred":
+            budget_spent.set()
+            work_queue.defer(owner, key)
+        else:
+            work_queue.complete(owner, key, "failed" if outcome == "failed" else "done")
+        with drained:
+            outstanding -= 1
+            drained.notify()
+
+    print(f"Worker {owner} leasing {lease_size} recipient(s) at a time from {os.path.abspath(work_queue.path)}\n")
+    renewer = threading.Thread(target=renew_leases, daemon=True)
+    renewer.start()
+    try:
+        summary = run(
+            config,
+            render_workers,
+            profile_every=profile_every,
+            profile_output=profile_output,
+            recipients=leased(),
+            on_finished=finished,
+        )
+    finally:
+        stopped.set()
+        renewer.join()
+        work_queue.release(owner)
+        counts = work_queue.counts()
+        work_queue.close()
+    print(f"Queue: {', '.join(f'{state}: {n}' for state, n in sorted(counts.items()))}")
+    return summary
+
+
+MERGED_COUNTS = ("attempted", "success", "failed", "skipped", "deferred", "retried", "dead_letters")
+
+
+def merge_summaries(paths):
+    # Combines the metrics JSON of each shard into the totals of a single run
+    summaries = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            summaries.append(json.load(f))
+
+    shards = {tuple(summary["shard"]) for summary in summaries if summary.get("shard")}
+    counts = {count for _, count in shards}
+    if len(counts) == 1:
+        count = counts.pop()
+        missing = sorted(set(range(count)) - {index for index, _ in shards})
+        if missing:
+            print(f"⚠️ Missing shard(s) {', '.join(map(str, missing))} of {count}")
+    elif len(counts) > 1:
+        print(f"⚠️ Summaries come from different shard counts: {sorted(counts)}")
+    if len(shards) < len(summaries) and shards:
+        print("⚠️ Some summaries are duplicated or come from unsharded runs")
 
+    totals = {key: sum(summary.get(key, 0) for summary in summaries) for key in MERGED_COUNTS}
+    totals["elapsed"] = max(summary["elapsed"] for summary in summaries)
+    for path, summary in zip(paths, summaries):
+        shard = "/".join(map(str, summary["shard"])) if summary.get("shard") else "-"
+        print(f"{shard:<8} {summary['success']} sent, {summary['failed']} failed in {summary['elapsed']:.1f}s  ({path})")
+    print_totals(totals)
+    if totals["dead_letters"]:
+        print(f"Dead letters: {totals['dead_letters']}")
+    print(f"Wall time: {totals['elapsed']:.1f}s (slowest shard)")
+    return totals
+
+
+def print_totals(totals):
     print("\n--- Summary ---")
-    print(f"Total attempted: {total}")
-    print(f"Successful: {success}")
-    print(f"Failed: {failed}")
+    print(f"Total attempted: {totals['attempted']}")
+    print(f"Successful: {totals['success']}")
+    print(f"Failed: {totals['failed']}")
+    if totals["skipped"]:
+        print(f"Skipped (already sent): {totals['skipped']}")
+    if totals["deferred"]:
+        print(f"Deferred (daily limit reached, rerun to send): {totals['deferred']}")
+    if totals["retried"]:
+        print(f"Retries after transient failures: {totals['retried']}")
+
+
+def dry_run(config, shard=None):
+    # Reads the recipient list and the ledger; renders, sends and writes nothing
+    ledger_path = config.get("ledger_path", "ledger.sqlite3")
+    ledger = RunLedger(ledger_path) if os.path.exists(ledger_path) else None
+    planned = {}
+    skipped = unknown = 0
+    try:
+        for idx, recipient in iter_recipients(config["input_csv"]):
+            name = recipient["name"].strip()
+            email = recipient["email"].strip()
+            group = recipient["piORth"].strip()
+            if not in_shard(email, shard):
+                continue
+            if group not in config["templates"]:
+                print(f"  !! Row {idx}: {name} <{email}> has unknown group {group!r}")
+                unknown += 1
+            elif ledger is not None and ledger.state(recipient_key(name, email, group)) == "sent":
+                skipped += 1
+            else:
+                planned[group] = planned.get(group, 0) + 1
+    finally:
+        if ledger is not None:
+            ledger.close()
+
+    for group in sorted(planned):
+        template = config["templates"][group]
+        missing = [path for path in (template["template_path"], template["font_path"]) if not os.path.exists(path)]
+        note = f" (missing: {', '.join(missing)})" if missing else ""
+        print(f"{group:<8} {planned[group]} certificate(s), render_mode={template.get('render_mode', 'raster')}{note}")
+    print("\n--- Dry run ---")
+    print(f"Would send: {sum(planned.values())}")
+    print(f"Skipped (already sent): {skipped}")
+    print(f"Unknown group: {unknown}")
+    return {"planned": planned, "skipped": skipped, "unknown": unknown}
+
+
+def run(
+    config,
+    render_workers=1,
+    total="?",
+    profile_every=0,
+    profile_output="profile.pstats",
+    mode="run",
+    shard=None,
+    recipients=None,
+    on_finished=None,
+):
+    # mode "run" renders and sends, "render" only writes certificates to
+    # output_folder and "send" mails the ones an earlier render left there.
+    # recipients yields (row_number, row) like iter_recipients, which is the
+    # default; on_finished(key, outcome) fires once per recipient.
+    rendering = mode != "send"
+    sending = mode != "render"
+    template_cache.max_bytes = config.get("template_cache_mb", 512) * 1024 * 1024
+    template_store.path = config.get("template_store_dir")
+    template_store.max_bytes = config.get("template_store_mb", 2048) * 1024 * 1024
+    output_folder = config["output_folder"]
+    started = time.monotonic()
+    counts = {"success": 0, "failed": 0, "skipped": 0, "deferred": 0}
+    counts_lock = threading.Lock()
+    ledger = RunLedger(
+        config.get("ledger_path", "ledger.sqlite3"),
+        batch_size=config.get("ledger_batch_size", 200),
+        flush_interval=config.get("ledger_flush_seconds", 1.0),
+    )
+    already_sent = ledger.counts().get("sent", 0)
+    if already_sent:
+        print(f"Resuming: {already_sent} recipient(s) in the ledger were already sent.\n")
+
+    def record(outcome, key):
+        with counts_lock:
+            counts[outcome] += 1
+        if on_finished is not None:
+            on_finished(key, outcome)
+
+    dead_letters = DeadLetterReport(config.get("dead_letter_csv", "dead_letter.csv"))
+    max_retries = config.get("retry_attempts", 3)
+
+    def fail(name, email, group, key, stage, error):
+        kind = classify_error(error, stage)
+        print(f"  !! Failed for {name} <{email}> ({kind} {stage} error): {error}\n")
+        ledger.mark(key, name, email, group, "failed", str(error))
+        dead_letters.add(name, email, group, stage, kind, error)
+        record("failed", key)
+
+    latency = {stage: LatencyStats() for stage in ("render", "build", "deliver", "total")}
+    shared = None
+    if rendering and render_workers > 1:
+        shared = SharedTemplates(config["templates"].values())
+    render_cache = None
+    if rendering and config.get("render_cache_dir"):
+        render_cache = RenderCache(config["render_cache_dir"], config.get("render_cache_mb", 1024) * 1024 * 1024)
+    metrics = Metrics()
+    profiler = Profiler(profile_every)
+
+    def on_sent(job, msg):
+        _, name, email, _, group, key, marks = job
+        attempts = 0
+
+        def done(error):
+            nonlocal attempts
+            if error is None:
+                now = time.monotonic()
+                latency["deliver"].add(now - marks[-1])
+                latency["total"].add(now - marks[0])
+                print(f"  ✅ Sent to {email}")
+                ledger.mark(key, name, email, group, "sent")
+                record("success", key)
+            elif isinstance(error, DailyLimitReached):
+                # Not a failure: the ledger still has it unsent, so the next run picks it up
+                print(f"  .. Deferred {email}: {error}")
+                record("deferred", key)
+            elif classify_error(error) == TRANSIENT and attempts < max_retries:
+                attempts += 1
+                delay = retries.retry((msg, done, False), attempts)
+                print(f"  .. Transient failure for {email}: {error}; retry {attempts}/{max_retries} in {delay:.1f}s")
+                return
+            else:
+                fail(name, email, group, key, "send", error)
+            retries.finished()
+        return done
+
+    capacity = config.get("pipeline_queue_size", 32)
+    load = Stage("load")
+    render = Stage("render" if rendering else "read", capacity)
+    load.downstream = render
+    build = pool = limiter = retries = None
+    if sending:
+        email_settings = config["email_settings"]
+        limiter = RateLimiter(
+            email_settings.get("max_per_second", 10),
+            per_day=email_settings.get("max_per_day"),
+            sent_today=ledger.sent_since(time.time() - 86400),
+        )
+        pool = make_pool(email_settings, limiter=limiter, metrics=metrics, profiler=profiler)
+        build = Stage("build", capacity)
+        retries = RetryQueue(pool.stage, config.get("retry_base_seconds", 2.0), config.get("retry_max_seconds", 60.0))
+        render.downstream = build
+        build.downstream = retries
+    archive = None
+    archive_dropped = 0
+    if mode == "render" or (mode == "run" and config.get("archive_output", True)):
+        archive = Stage("archive", capacity)
+    stages = [stage for stage in (load, render, build, pool and pool.stage, archive) if stage is not None]
+
+    def fail_job(job, stage_name, error):
+        _, name, email, _, group, key, _ = job
+        fail(name, email, group, key, stage_name, error)
+
+    render.on_error = lambda job, error: fail_job(job, render.name, error)
+    if sending:
+        build.on_error = lambda item, error: fail_job(item[0], "build", error)
+        pool.stage.on_error = lambda item, error: item[1](error)
+    if archive is not None:
+        if sending:
+            archive.on_error = lambda item, error: print(f"  !! Could not archive {item[2]}: {error}")
+        else:
+            archive.on_error = lambda item, error: fail_job(item[0], "archive", error)
+
+    def load_worker(stage, _):
+        for idx, recipient in recipients or iter_recipients(config["input_csv"]):
+            name = recipient["name"].strip()
+            email = recipient["email"].strip()
+            group = recipient["piORth"].strip()
+            if not in_shard(email, shard):
+                continue
+            stage.processed += 1
+
+            key = recipient_key(name, email, group)
+            if group not in config["templates"]:
+                print(f"[{idx}/{total}] Processing: {name} <{email}>")
+                fail(name, email, group, key, "load", ValueError(f"Unknown group: {group}"))
+                continue
+
+            if already_sent and ledger.state(key) == "sent":
+                record("skipped", key)
+                continue
+
+            if limiter is not None and limiter.exhausted():
+                # Out of daily budget: stop rendering and sending, and leave the rest for a rerun
+                record("deferred", key)
+                continue
+
+            stage.emit((idx, name, email, config["templates"][group], group, key, [time.monotonic()]))
+
+    def render_worker(stage, _):
+        nonlocal archive_dropped
+        if rendering:
+            results = render_certificates(
+                stage, render_workers, metrics, profiler, render_cache, shared, max_retries
+            )
+        else:
+            results = read_certificates(stage, output_folder)
+        for job, data, error in results:
+            idx, name, email, _, group, key, marks = job
+            print(f"[{idx}/{total}] Processing: {name} <{email}>")
+            if error is not None:
+                fail(name, email, group, key, stage.name, error)
+                continue
+            filename = certificate_filename(name, job[3])
+            print(f"  -> {'Rendered' if rendering else 'Read'}: {filename} ({len(data) // 1024} KB)")
+            marks.append(time.monotonic())
+            latency["render"].add(marks[-1] - marks[-2])
+            if rendering:
+                ledger.mark(key, name, email, group, "rendered")
+            if sending:
+                stage.emit((job, data, filename))
+            if archive is None:
+                continue
+            if not sending:
+                archive.put((job, data, filename))
+            elif not archive.offer((job, data, filename)):
+                # A slow disk must not hold up rendering and, behind it, sending
+                print(f"  !! Archive queue full, not saving {filename}")
+                archive_dropped += 1
+
+    def build_worker(stage, _):
+        for job, data, filename in stage:
+            idx, name, email, template_cfg, group, key, marks = job
+            try:
+                with collect_timings() as timings, timed("build.mime"):
+                    msg = build_email(name, email, data, filename, template_cfg, config["email_settings"])
+            except Exception as e:
+                fail(name, email, group, key, "build", e)
+                continue
+            metrics.merge(timings)
+            marks.append(time.monotonic())
+            latency["build"].add(marks[-1] - marks[-2])
+            stage.emit((msg, on_sent(job, msg), profiler.wants(idx)))
+
+    def archive_worker(stage, _):
+        for job, data, filename in stage:
+            _, name, email, _, group, key, _ = job
+            try:
+                output_file = save_certificate(data, filename, output_folder)
+            except OSError as e:
+                if sending:
+                    print(f"  !! Could not archive {filename}: {e}")
+                else:
+                    fail(name, email, group, key, "archive", e)
+                continue
+            print(f"  -> Saved: {output_file}")
+            if not sending:
+                record("success", key)
+
+    try:
+        if archive is not None:
+            archive.start(archive_worker)
+        if sending:
+            build.start(build_worker)
+        render.start(render_worker)
+        load.start(load_worker)
+        for stage in (load, render, build):
+            if stage is not None:
+                stage.join()
+        if archive is not None:
+            archive.close()
+        if sending:
+            retries.join()
+            pool.close()
+        if archive is not None:
+            archive.join()
+    finally:
+        # Whatever was delivered must reach the ledger, even on Ctrl+C
+        ledger.close()
+        dead_letters.close()
+        if shared is not None:
+            shared.close()
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+    elapsed = time.monotonic() - started
+
+    totals = {
+        "attempted": load.processed,
+        "success": counts["success"],
+        "failed": counts["failed"],
+        "skipped": counts["skipped"],
+        "deferred": counts["deferred"],
+        "retried": retries.retried if retries else 0,
+        "dead_letters": dead_letters.count,
+    }
+    print_totals(totals)
+    if dead_letters.count:
+        print(f"Dead letters: {dead_letters.count} written to {os.path.abspath(dead_letters.path)}")
+    if archive_dropped:
+        print(f"Archive: {archive_dropped} certificate(s) not saved because the archive could not keep up")
+    if sending:
+        for conn in pool.stats():
+            print(
+                f"SMTP connection {conn['connection']}: {conn['messages']} sent, {conn['logins']} logins, "
+                f"{conn['messages_per_second']} msg/s over {conn['busy_seconds']}s"
+            )
+        rate = "unlimited" if math.isinf(limiter.max_rate) else f"{limiter.rate:.2f}/{limiter.max_rate:.2f} msg/s"
+        print(
+            f"Rate limit: {rate} after {limiter.throttles} throttle(s), "
+            f"{limiter.sent_today} attempt(s) counted against the daily budget ({limiter.per_day or 'unlimited'})"
+        )
+    print("\n--- Pipeline ---")
+    for stage in stages:
+        stats = stage.stats()
+        print(
+            f"{stats['stage']:<8} {stats['processed']} items, {stats['threads']} thread(s), "
+            f"{stats['utilization']:.0%} busy, queue avg {stats['avg_depth']:.1f} / max {stats['max_depth']}"
+            f" of {stats['capacity'] or 'unbounded'}"
+        )
+    print("\n--- Latency (queue wait included) ---")
+    for stage, stats in latency.items():
+        if not stats.count:
+            continue
+        print(f"{stage:<8} p50 {stats.percentile(50) * 1000:8.1f} ms   p99 {stats.percentile(99) * 1000:8.1f} ms")
+    if rendering and render_workers <= 1:
+        fonts = font_registry.stats()
+        print(f"Font cache: {fonts['hits']} hits, {fonts['misses']} misses ({fonts['fonts']} loaded)")
+    if render_cache is not None:
+        cached = render_cache.stats()
+        print(
+            f"Render cache: {cached['hits']} hits, {cached['misses']} misses, {cached['evictions']} evicted "
+            f"({cached['entries']} certificates, {cached['megabytes']} MB)"
+        )
+    steps = metrics.report()
+    print("\n--- Steps (time spent inside each step) ---")
+    for step, stats in steps.items():
+        print(
+            f"{step:<16} n={stats['count']:<6} mean {stats['mean_ms']:8.2f} ms   p50 {stats['p50_ms']:8.2f} ms"
+            f"   p99 {stats['p99_ms']:8.2f} ms   max {stats['max_ms']:8.2f} ms"
+        )
+    if profiler.samples:
+        profiler.dump(profile_output)
+        print(f"Profile: {profiler.samples} sample(s) written to {os.path.abspath(profile_output)}")
+
+    summary = {
+        **totals,
+        "shard": list(shard) if shard else None,
+        "mode": mode,
+        "elapsed": elapsed,
+        "latency": {stage: stats.summary() for stage, stats in latency.items()},
+        "stages": [stage.stats() for stage in stages],
+        "steps": steps,
+        "archive_dropped": archive_dropped,
+    }
+    metrics_path = config.get("metrics_json", "metrics.json")
+    if metrics_path:
+        with open(metrics_path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Metrics: {os.path.abspath(metrics_path)}")
     print("Finished.")
+    return summary
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
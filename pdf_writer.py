@@ -0,0 +1,390 @@
+import hashlib
+import os
+import struct
+import zlib
+from functools import lru_cache
+
+from PIL import Image
+
+
+def _checksum(data):
+    data += b"\0" * (-len(data) % 4)
+    return sum(struct.unpack(f">{len(data) // 4}I", data)) & 0xFFFFFFFF
+
+
+class TrueTypeFont:
+    # Only what the PDF writer needs: cmap lookup, metrics and glyf subsetting
+    KEEP_TABLES = ("head", "hhea", "maxp", "cvt ", "fpgm", "prep")
+
+    def __init__(self, data):
+        if data[:4] not in (b"\x00\x01\x00\x00", b"true"):
+            raise ValueError("Only TrueType (glyf) fonts can be embedded in native PDF output")
+        self.data = data
+        self.tables = {}
+        num_tables = struct.unpack(">H", data[4:6])[0]
+        for i in range(num_tables):
+            tag, _, offset, length = struct.unpack(">4sIII", data[12 + 16 * i : 28 + 16 * i])
+            self.tables[tag.decode("latin-1")] = (offset, length)
+
+        head = self.table("head")
+        self.units_per_em = struct.unpack(">H", head[18:20])[0]
+        self.bbox = struct.unpack(">hhhh", head[36:44])
+        long_loca = struct.unpack(">h", head[50:52])[0] == 1
+        self.num_glyphs = struct.unpack(">H", self.table("maxp")[4:6])[0]
+
+        hhea = self.table("hhea")
+        self.ascent, self.descent = struct.unpack(">hh", hhea[4:8])
+        self.num_hmetrics = struct.unpack(">H", hhea[34:36])[0]
+        self.cap_height = self.ascent
+        os2 = self.table("OS/2")
+        if len(os2) >= 90 and struct.unpack(">H", os2[0:2])[0] >= 2:
+            self.cap_height = struct.unpack(">h", os2[88:90])[0]
+
+        hmtx = self.table("hmtx")
+        advances = [struct.unpack(">H", hmtx[4 * i : 4 * i + 2])[0] for i in range(self.num_hmetrics)]
+        self.advances = advances + [advances[-1]] * (self.num_glyphs - self.num_hmetrics)
+
+        loca = self.table("loca")
+        if long_loca:
+            self.offsets = struct.unpack(f">{self.num_glyphs + 1}I", loca[: 4 * (self.num_glyphs + 1)])
+        else:
+            self.offsets = [2 * o for o in struct.unpack(f">{self.num_glyphs + 1}H", loca[: 2 * (self.num_glyphs + 1)])]
+
+        self.cmap = self._read_cmap()
+        self.postscript_name = self._read_name(6) or "Font"
+
+    def table(self, tag):
+        if tag not in self.tables:
+            return b""
+        offset, length = self.tables[tag]
+        return self.data[offset : offset + length]
+
+    def glyph_ids(self, text):
+        return [self.cmap.get(ord(ch), 0) for ch in text]
+
+    def advance(self, gid):
+        return self.advances[gid] * 1000 / self.units_per_em
+
+    def scaled(self, value):
+        return round(value * 1000 / self.units_per_em)
+
+    def subset(self, glyph_ids):
+        # Glyph ids stay stable; unused glyphs are emptied instead of renumbered
+        glyf = self.table("glyf")
+        keep = set()
+        pending = [0, *glyph_ids]
+        while pending:
+            gid = pending.pop()
+            if gid in keep or gid >= self.num_glyphs:
+                continue
+            keep.add(gid)
+            pending.extend(self._components(glyf, gid))
+
+        new_glyf = bytearray()
+        loca = []
+        for gid in range(self.num_glyphs):
+            loca.append(len(new_glyf))
+            if gid in keep:
+                new_glyf += glyf[self.offsets[gid] : self.offsets[gid + 1]]
+                new_glyf += b"\0" * (-len(new_glyf) % 4)
+        loca.append(len(new_glyf))
+
+        hmtx = self.table("hmtx")
+        new_hmtx = bytearray(len(hmtx))
+        for gid in keep:
+            if gid < self.num_hmetrics:
+                new_hmtx[4 * gid : 4 * gid + 4] = hmtx[4 * gid : 4 * gid + 4]
+            else:
+                pos = 4 * self.num_hmetrics + 2 * (gid - self.num_hmetrics)
+                new_hmtx[pos : pos + 2] = hmtx[pos : pos + 2]
+
+        head = bytearray(self.table("head"))
+        head[8:12] = b"\0\0\0\0"
+        head[50:52] = struct.pack(">h", 1)
+
+        tables = {tag: self.table(tag) for tag in self.KEEP_TABLES if tag in self.tables}
+        tables["head"] = bytes(head)
+        tables["glyf"] = bytes(new_glyf)
+        tables["loca"] = struct.pack(f">{len(loca)}I", *loca)
+        tables["hmtx"] = bytes(new_hmtx)
+        return self._assemble(tables)
+
+    def _components(self, glyf, gid):
+        start, end = self.offsets[gid], self.offsets[gid + 1]
+        if end - start < 10 or struct.unpack(">h", glyf[start : start + 2])[0] >= 0:
+            return []
+        components = []
+        pos = start + 10
+        while True:
+            flags, component = struct.unpack(">HH", glyf[pos : pos + 4])
+            components.append(component)
+            pos += 4 + (4 if flags & 0x0001 else 2)
+            if flags & 0x0008:
+                pos += 2
+            elif flags & 0x0040:
+                pos += 4
+            elif flags & 0x0080:
+                pos += 8
+            if not flags & 0x0020:
+                return components
+
+    def _assemble(self, tables):
+        tags = sorted(tables)
+        count = len(tags)
+        selector = count.bit_length() - 1
+        search_range = (1 << selector) * 16
+        header = struct.pack(">IHHHH", 0x00010000, count, search_range, selector, count * 16 - search_range)
+
+        offset = 12 + 16 * count
+        directory, body = [], []
+        head_offset = 0
+        for tag in tags:
+            data = tables[tag]
+            if tag == "head":
+                head_offset = offset
+            directory.append(struct.pack(">4sIII", tag.encode("latin-1"), _checksum(data), offset, len(data)))
+            padded = data + b"\0" * (-len(data) % 4)
+            body.append(padded)
+            offset += len(padded)
+
+        font = bytearray(header + b"".join(directory) + b"".join(body))
+        adjustment = (0xB1B0AFBA - _checksum(bytes(font))) & 0xFFFFFFFF
+        font[head_offset + 8 : head_offset + 12] = struct.pack(">I", adjustment)
+        return bytes(font)
+
+    def _read_cmap(self):
+        cmap = self.table("cmap")
+        subtables = {}
+        for i in range(struct.unpack(">H", cmap[2:4])[0]):
+            platform, encoding, offset = struct.unpack(">HHI", cmap[4 + 8 * i : 12 + 8 * i])
+            subtables[(platform, encoding)] = offset
+
+        for key in ((3, 10), (0, 4), (3, 1), (0, 3)):
+            if key not in subtables:
+                continue
+            offset = subtables[key]
+            fmt = struct.unpack(">H", cmap[offset : offset + 2])[0]
+            if fmt == 12:
+                return self._read_cmap12(cmap, offset)
+            if fmt == 4:
+                return self._read_cmap4(cmap, offset)
+        raise ValueError("Font has no Unicode cmap")
+
+    @staticmethod
+    def _read_cmap4(cmap, offset):
+        segments = struct.unpack(">H", cmap[offset + 6 : offset + 8])[0] // 2
+        ends_at = offset + 14
+        starts_at = ends_at + 2 * segments + 2
+        deltas_at = starts_at + 2 * segments
+        ranges_at = deltas_at + 2 * segments
+        mapping = {}
+        for seg in range(segments):
+            end = struct.unpack(">H", cmap[ends_at + 2 * seg : ends_at + 2 * seg + 2])[0]
+            start = struct.unpack(">H", cmap[starts_at + 2 * seg : starts_at + 2 * seg + 2])[0]
+            delta = struct.unpack(">h", cmap[deltas_at + 2 * seg : deltas_at + 2 * seg + 2])[0]
+            range_pos = ranges_at + 2 * seg
+            range_offset = struct.unpack(">H", cmap[range_pos : range_pos + 2])[0]
+            for code in range(start, end + 1):
+                if code == 0xFFFF:
+                    continue
+                if range_offset == 0:
+                    gid = (code + delta) & 0xFFFF
+                else:
+                    pos = range_pos + range_offset + 2 * (code - start)
+                    gid = struct.unpack(">H", cmap[pos : pos + 2])[0]
+                    if gid:
+                        gid = (gid + delta) & 0xFFFF
+                if gid:
+                    mapping[code] = gid
+        return mapping
+
+    @staticmethod
+    def _read_cmap12(cmap, offset):
+        groups = struct.unpack(">I", cmap[offset + 12 : offset + 16])[0]
+        mapping = {}
+        for i in range(groups):
+            start, end, gid = struct.unpack(">III", cmap[offset + 16 + 12 * i : offset + 28 + 12 * i])
+            for code in range(start, end + 1):
+                mapping[code] = gid + code - start
+        return mapping
+
+    def _read_name(self, name_id):
+        names = self.table("name")
+        if not names:
+            return None
+        count, string_offset = struct.unpack(">HH", names[2:6])
+        for i in range(count):
+            platform, _, _, nid, length, offset = struct.unpack(">6H", names[6 + 12 * i : 18 + 12 * i])
+            if nid != name_id:
+                continue
+            raw = names[string_offset + offset : string_offset + offset + length]
+            value = raw.decode("utf-16-be" if platform in (0, 3) else "latin-1", errors="ignore")
+            value = "".join(ch for ch in value if ch.isalnum() or ch in "-_")
+            if value:
+                return value
+        return None
+
+
+class JPEGTemplate:
+    def __init__(self, path):
+        with Image.open(path) as image:
+            if image.format != "JPEG":
+                raise ValueError(f"Native PDF output needs a JPEG template: {path}")
+            self.width, self.height = image.size
+            mode = image.mode
+        with open(path, "rb") as f:
+            self.data = f.read()
+
+        self.decode = b""
+        if mode == "L":
+            self.color_space, self.components = b"/DeviceGray", 1
+        elif mode == "CMYK":
+            # Adobe CMYK JPEGs are stored inverted
+            self.color_space, self.components = b"/DeviceCMYK", 4
+            self.decode = b" /Decode [1 0 1 0 1 0 1 0]"
+        else:
+            self.color_space, self.components = b"/DeviceRGB", 3
+
+
+@lru_cache(maxsize=32)
+def _load_jpeg(path, mtime):
+    return JPEGTemplate(path)
+
+
+@lru_cache(maxsize=16)
+def _load_font(path, mtime):
+    with open(path, "rb") as f:
+        return TrueTypeFont(f.read())
+
+
+def load_jpeg(path):
+    return _load_jpeg(os.path.abspath(path), os.path.getmtime(path))
+
+
+def load_font(path):
+    return _load_font(os.path.abspath(path), os.path.getmtime(path))
+
+
+def _num(value):
+    return (b"%.3f" % value).rstrip(b"0").rstrip(b".")
+
+
+def _stream(entries, data):
+    return b"<< " + entries + b" /Length %d >>\nstream\n" % len(data) + data + b"\nendstream"
+
+
+def _to_unicode(pairs):
+    lines = [
+        b"/CIDInit /ProcSet findresource begin",
+        b"12 dict begin",
+        b"begincmap",
+        b"/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def",
+        b"/CMapName /Adobe-Identity-UCS def",
+        b"/CMapType 2 def",
+        b"1 begincodespacerange",
+        b"<0000> <FFFF>",
+        b"endcodespacerange",
+    ]
+    pairs = sorted(pairs.items())
+    for i in range(0, len(pairs), 100):
+        chunk = pairs[i : i + 100]
+        lines.append(b"%d beginbfchar" % len(chunk))
+        for gid, text in chunk:
+            lines.append(b"<%04X> <%s>" % (gid, text.encode("utf-16-be").hex().upper().encode()))
+        lines.append(b"endbfchar")
+    lines += [b"endcmap", b"CMapName currentdict /CMap defineresource pop", b"end", b"end"]
+    return b"\n".join(lines)
+
+
+def _write_pdf(objects):
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def build_image_pdf(width, height, stream, entries):
+    # A single full-page image; entries carry /ColorSpace, /Filter, /DecodeParms etc.
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents 4 0 R"
+        b" /Resources << /XObject << /Im0 5 0 R >> >> >>" % (width, height),
+        _stream(b"", b"q %d 0 0 %d 0 0 cm /Im0 Do Q\n" % (width, height)),
+        _stream(
+            b"/Type /XObject /Subtype /Image /Width %d /Height %d /BitsPerComponent 8 " % (width, height) + entries,
+            stream,
+        ),
+    ]
+    return _write_pdf(objects)
+
+
+def build_certificate_pdf(jpeg, font, text, font_size, color, x, baseline):
+    # x and baseline are in template pixels from the top-left, which is also
+    # the page size in points (the same 72 dpi Pillow uses when saving PDFs)
+    gids = font.glyph_ids(text)
+    used = {}
+    for gid, ch in zip(gids, text):
+        used.setdefault(gid, ch)
+
+    font_program = font.subset(gids)
+    digest = hashlib.md5(bytes(str(sorted(used)), "ascii")).digest()
+    tag = bytes(65 + b % 26 for b in digest[:6])
+    base_font = b"/" + tag + b"+" + font.postscript_name.encode("ascii")
+
+    widths = b" ".join(b"%d [%s]" % (gid, _num(font.advance(gid))) for gid in sorted(used))
+    r, g, b = (_num(c / 255) for c in color[:3])
+    content = (
+        b"q %d 0 0 %d 0 0 cm /Im0 Do Q\n" % (jpeg.width, jpeg.height)
+        + b"BT /F1 %s Tf %s %s %s rg %s %s Td <%s> Tj ET\n"
+        % (
+            _num(font_size),
+            r,
+            g,
+            b,
+            _num(x),
+            _num(jpeg.height - baseline),
+            b"".join(b"%04X" % gid for gid in gids),
+        )
+    )
+    x_min, y_min, x_max, y_max = (font.scaled(v) for v in font.bbox)
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Contents 4 0 R"
+        b" /Resources << /XObject << /Im0 5 0 R >> /Font << /F1 6 0 R >> >> >>" % (jpeg.width, jpeg.height),
+        _stream(b"", content),
+        _stream(
+            b"/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8"
+            b" /Filter /DCTDecode%s" % (jpeg.width, jpeg.height, jpeg.color_space, jpeg.decode),
+            jpeg.data,
+        ),
+        b"<< /Type /Font /Subtype /Type0 /BaseFont %s /Encoding /Identity-H"
+        b" /DescendantFonts [7 0 R] /ToUnicode 10 0 R >>" % base_font,
+        b"<< /Type /Font /Subtype /CIDFontType2 /BaseFont %s"
+        b" /CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >>"
+        b" /FontDescriptor 8 0 R /CIDToGIDMap /Identity /W [%s] >>" % (base_font, widths),
+        b"<< /Type /FontDescriptor /FontName %s /Flags 4 /FontBBox [%d %d %d %d] /ItalicAngle 0"
+        b" /Ascent %d /Descent %d /CapHeight %d /StemV 80 /FontFile2 9 0 R >>"
+        % (
+            base_font,
+            x_min,
+            y_min,
+            x_max,
+            y_max,
+            font.scaled(font.ascent),
+            font.scaled(font.descent),
+            font.scaled(font.cap_height),
+        ),
+        _stream(b"/Filter /FlateDecode /Length1 %d" % len(font_program), zlib.compress(font_program)),
+        _stream(b"", _to_unicode(used)),
+    ]
+    return _write_pdf(objects)
@@ -0,0 +1,177 @@
+import heapq
+import itertools
+import queue
+import random
+import threading
+import time
+
+STOP = object()
+
+
+class Stage:
+    def __init__(self, name, capacity=0):
+        self.name = name
+        self.capacity = capacity
+        self.inbox = queue.Queue(maxsize=capacity)
+        self.downstream = None
+        # on_error(item, error) settles the items left in the inbox after a thread
+        # crashed; stages that generate their own items (no inbox) leave it unset
+        self.on_error = None
+        self.error = None
+        self.processed = 0
+        self.idle_seconds = 0.0
+        self.thread_seconds = 0.0
+        self.max_depth = 0
+        self._depth_total = 0
+        self._depth_samples = 0
+        self._threads = []
+        self._live = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def start(self, target, count=1):
+        # target(stage, index) runs in each of `count` threads
+        self._live = count
+        for index in range(count):
+            thread = threading.Thread(target=self._run, args=(target, index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, item):
+        depth = self.inbox.qsize()
+        with self._lock:
+            self._depth_total += depth
+            self._depth_samples += 1
+            self.max_depth = max(self.max_depth, depth)
+        self.inbox.put(item)
+
+    def offer(self, item):
+        # put() that gives up instead of waiting when the inbox is full
+        try:
+            self.inbox.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def emit(self, item):
+        start = time.monotonic()
+        self.downstream.put(item)
+        with self._lock:
+            self.idle_seconds += time.monotonic() - start
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for _ in range(max(1, len(self._threads))):
+            self.inbox.put(STOP)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def __iter__(self):
+        while True:
+            start = time.monotonic()
+            item = self.inbox.get()
+            with self._lock:
+                self.idle_seconds += time.monotonic() - start
+            if item is STOP:
+                return
+            yield item
+            with self._lock:
+                self.processed += 1
+
+    def stats(self):
+        busy = self.thread_seconds - self.idle_seconds
+        return {
+            "stage": self.name,
+            "threads": len(self._threads),
+            "processed": self.processed,
+            "utilization": busy / self.thread_seconds if self.thread_seconds else 0.0,
+            "avg_depth": self._depth_total / self._depth_samples if self._depth_samples else 0.0,
+            "max_depth": self.max_depth,
+            "capacity": self.capacity,
+        }
+
+    def _run(self, target, index):
+        start = time.monotonic()
+        try:
+            target(self, index)
+        except Exception as e:
+            print(f"  !! {self.name} stage crashed: {e!r}")
+            with self._lock:
+                self.error = self.error or e
+            # Keep taking items until this thread's stop marker, so upstream
+            # never blocks on a full inbox and every item is still accounted for
+            if self.on_error is not None:
+                for item in self:
+                    self.on_error(item, e)
+        finally:
+            with self._lock:
+                self.thread_seconds += time.monotonic() - start
+                self._live -= 1
+                last = self._live == 0
+            if last and self.downstream is not None:
+                self.downstream.close()
+
+
+class RetryQueue:
+    # Sits in front of the deliver stage. It counts messages in flight,
+    # re-submits transient failures after a capped exponential backoff, and
+    # closes the deliver stage only once no message can come back for retry.
+    def __init__(self, stage, base_delay=2.0, max_delay=60.0):
+        self.stage = stage
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.retried = 0
+        self._heap = []
+        self._seq = itertools.count()
+        self._input_closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def put(self, item):
+        with self._cond:
+            self.in_flight += 1
+        self.stage.put(item)
+
+    def retry(self, item, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), item))
+            self.retried += 1
+            self._cond.notify()
+        return delay
+
+    def finished(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._input_closed = True
+            self._cond.notify()
+
+    def join(self):
+        self._thread.join()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._input_closed and self.in_flight == 0:
+                        break
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                if not self._heap or self._heap[0][0] > time.monotonic():
+                    self.stage.close()
+                    return
+                item = heapq.heappop(self._heap)[2]
+            self.stage.put(item)
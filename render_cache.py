@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+# Part of every key; bump it when a rendering change alters the bytes produced
+# for the same inputs, so stale certificates are never served
+VERSION = 2
+
+
+@lru_cache(maxsize=64)
+def _file_digest(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class RenderCache:
+    # Rendered certificates stored under a hash of everything that affects
+    # their bytes: the name, the template and font file contents and the
+    # template settings (size, color, position, render mode, ...). Email
+    # settings are left out, so fixing a typo in email_body reuses every
+    # certificate, and so do other events that share a template.
+    #
+    # Least recently used entries are deleted once the directory grows past
+    # max_bytes. Several processes may share a directory; each only accounts
+    # for the entries it found at startup or wrote itself.
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def key(self, name, template_config):
+        settings = {k: v for k, v in template_config.items() if not k.startswith("email_")}
+        settings["template_path"] = file_digest(template_config["template_path"])
+        settings["font_path"] = file_digest(template_config["font_path"])
+        identity = json.dumps({"version": VERSION, "name": name, "settings": settings}, sort_keys=True)
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+                self._forget(key)
+            return None
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                self._add(key, len(data))
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a reader never sees half a certificate
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        with self._lock:
+            self._forget(key)
+            self._add(key, len(data))
+            self._evict()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "megabytes": round(self.total_bytes / (1024 * 1024), 1),
+        }
+
+    def _path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _scan(self):
+        found = []
+        for directory, _, files in os.walk(self.path):
+            for filename in files:
+                if filename.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(directory, filename))
+                found.append((stat.st_mtime, filename, stat.st_size))
+        for _, key, size in sorted(found):
+            self._add(key, size)
+        self._evict()
+
+    def _add(self, key, size):
+        self._entries[key] = size
+        self.total_bytes += size
+
+    def _forget(self, key):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
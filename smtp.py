@@ -0,0 +1,363 @@
+import asyncio
+import math
+import random
+import smtplib
+import threading
+import time
+
+from async_smtp import AsyncSMTPSession
+from pipeline import STOP, Stage
+from timing import Profiler, collect_timings, timed
+
+class SMTPSession:
+    def __init__(self, email_settings):
+        self.host = email_settings.get("smtp_host", "smtp.gmail.com")
+        self.port = email_settings.get("smtp_port", 587)
+        self.security = email_settings.get("smtp_security", "starttls")
+        self.sender_email = email_settings["sender_email"]
+        self.sender_password = email_settings["sender_password"]
+        self.max_messages = email_settings.get("max_messages_per_connection", 100)
+        self.keepalive_seconds = email_settings.get("keepalive_seconds", 30)
+        self.timeout = email_settings.get("timeout_seconds", 60)
+        self.messages_sent = 0
+        self.connections_opened = 0
+        self.busy_seconds = 0.0
+        self._smtp = None
+        self._sent_on_connection = 0
+        self._last_used = 0.0
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._keepalive_thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        with self._lock:
+            self._disconnect()
+            with timed("send.connect"):
+                if self.security == "ssl":
+                    smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+                else:
+                    smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                if self.security == "starttls":
+                    with timed("send.tls"):
+                        smtp.starttls()
+                with timed("send.auth"):
+                    smtp.login(self.sender_email, self.sender_password)
+            except Exception:
+                smtp.close()
+                raise
+            self._smtp = smtp
+            self._sent_on_connection = 0
+            self._last_used = time.monotonic()
+            self.connections_opened += 1
+        if self.keepalive_seconds and self._keepalive_thread is None:
+            self._stop.clear()
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+            self._keepalive_thread.start()
+
+    def send(self, msg):
+        with self._lock:
+            start = time.monotonic()
+            if self._smtp is None or self._sent_on_connection >= self.max_messages:
+                self.connect()
+            try:
+                with timed("send.data"):
+                    self._smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self.connect()
+                with timed("send.data"):
+                    self._smtp.send_message(msg)
+            self._sent_on_connection += 1
+            self._last_used = time.monotonic()
+            self.messages_sent += 1
+            self.busy_seconds += self._last_used - start
+
+    def close(self):
+        self._stop.set()
+        if self._keepalive_thread is not None:
+            self._keepalive_thread.join()
+            self._keepalive_thread = None
+        with self._lock:
+            self._disconnect()
+
+    def reset(self):
+        with self._lock:
+            self._disconnect()
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(self.keepalive_seconds):
+            with self._lock:
+                if self._smtp is None or time.monotonic() - self._last_used < self.keepalive_seconds:
+                    continue
+                try:
+                    code, _ = self._smtp.noop()
+                except (smtplib.SMTPException, OSError):
+                    code = None
+                if code == 250:
+                    self._last_used = time.monotonic()
+                else:
+                    # Drop it; the next send reconnects
+                    self._smtp.close()
+                    self._smtp = None
+
+
+THROTTLE_CODES = {421, 450, 451, 452, 454}
+
+
+class DailyLimitReached(Exception):
+    pass
+
+
+def smtp_code(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return codes[0] if codes else None
+    return getattr(error, "smtp_code", None)
+
+
+class RateLimiter:
+    # Token bucket shared by every connection of one sender account. Throttle
+    # replies halve the rate and pause sending with a jittered, growing backoff;
+    # each success ramps the rate back up towards the configured ceiling.
+    # per_second None leaves the rate uncapped; the daily budget and throttle
+    # pauses still apply.
+    def __init__(self, per_second, per_day=None, sent_today=0, burst=None, max_backoff=300.0):
+        if per_second is not None and per_second <= 0:
+            raise ValueError(f"max_per_second must be positive, or null for no rate limit (got {per_second})")
+        self.max_rate = float(per_second) if per_second is not None else math.inf
+        self.min_rate = min(self.max_rate, 0.05)
+        self.rate = self.max_rate
+        self.capacity = float(burst or max(1.0, self.max_rate))
+        self.tokens = self.capacity
+        self.per_day = per_day
+        self.sent_today = sent_today
+        self.max_backoff = max_backoff
+        self.backoff = 0.0
+        self.throttles = 0
+        self._paused_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Takes a token and returns 0, or returns how long to wait before asking again
+        with self._lock:
+            if self.per_day is not None and self.sent_today >= self.per_day:
+                raise DailyLimitReached(f"Daily sending limit of {self.per_day} reached")
+            now = time.monotonic()
+            if math.isinf(self.rate):
+                self.tokens = self.capacity
+            else:
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = self._paused_until - now
+            if wait > 0:
+                return wait
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.sent_today += 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def exhausted(self):
+        with self._lock:
+            return self.per_day is not None and self.sent_today >= self.per_day
+
+    def acquire(self):
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.backoff = min(self.max_backoff, self.backoff * 2 if self.backoff else 1.0)
+            self.tokens = 0.0
+            delay = self.backoff * random.uniform(0.5, 1.5)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            return delay
+
+    def succeeded(self):
+        with self._lock:
+            # Halve the backoff, and once it falls below the 1s base the next throttle starts over from 1s
+            self.backoff = self.backoff / 2 if self.backoff >= 2.0 else 0.0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class SMTPPool:
+    def __init__(self, email_settings, size=None, limiter=None, metrics=None, profiler=None):
+        size = max(1, size or email_settings.get("connections", 1))
+        self.limiter = limiter
+        self.metrics = metrics
+        self.profiler = profiler or Profiler()
+        self.throttle_retries = email_settings.get("throttle_retries", 5)
+        self.sessions = [SMTPSession(email_settings) for _ in range(size)]
+        self.stage = Stage("deliver", capacity=size * 2)
+        self.stage.start(self._worker, count=size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, msg, on_done, profile=False):
+        self.stage.put((msg, on_done, profile))
+
+    def close(self):
+        self.stage.close()
+        self.stage.join()
+        for session in self.sessions:
+            session.close()
+
+    def stats(self):
+        return [
+            {
+                "connection": idx,
+                "messages": session.messages_sent,
+                "logins": session.connections_opened,
+                "busy_seconds": round(session.busy_seconds, 3),
+                "messages_per_second": round(session.messages_sent / session.busy_seconds, 2) if session.busy_seconds else 0.0,
+            }
+            for idx, session in enumerate(self.sessions, start=1)
+        ]
+
+    def _worker(self, stage, index):
+        session = self.sessions[index]
+        for msg, on_done, profile in stage:
+            try:
+                with collect_timings() as timings, self.profiler.profile(profile):
+                    error = self._deliver(session, msg)
+            except Exception as e:
+                # The message must be settled whatever went wrong, or the retry queue never drains
+                error = e
+            else:
+                if self.metrics is not None:
+                    self.metrics.merge(timings)
+            on_done(error)
+
+    def _deliver(self, session, msg):
+        attempt = 0
+        while True:
+            try:
+                if self.limiter is not None:
+                    self.limiter.acquire()
+                session.send(msg)
+            except Exception as e:
+                if self.limiter is None or smtp_code(e) not in THROTTLE_CODES or attempt >= self.throttle_retries:
+                    return e
+                attempt += 1
+                session.reset()
+                delay = self.limiter.throttled()
+                print(f"  .. Throttled ({smtp_code(e)}), backing off {delay:.1f}s at {self.limiter.rate:.2f} msg/s")
+            else:
+                if self.limiter is not None:
+                    self.limiter.succeeded()
+                return None
+
+
+class AsyncSMTPPool(SMTPPool):
+    # Same surface as SMTPPool, but every connection is a coroutine on one
+    # event loop thread, so hundreds of sessions cost no extra threads
+    def __init__(self, email_settings, size=None, limiter=None, metrics=None, profiler=None):
+        size = max(1, size or email_settings.get("connections", 1))
+        self.limiter = limiter
+        self.metrics = metrics
+        self.throttle_retries = email_settings.get("throttle_retries", 5)
+        self.keepalive_seconds = email_settings.get("keepalive_seconds", 30)
+        self.sessions = [AsyncSMTPSession(email_settings) for _ in range(size)]
+        self.stage = Stage("deliver", capacity=size * 2)
+        self.stage.start(self._run_loop)
+
+    def close(self):
+        # Sessions are closed by the event loop before it exits
+        self.stage.close()
+        self.stage.join()
+
+    def _run_loop(self, stage, _):
+        asyncio.run(self._dispatch(stage))
+
+    async def _dispatch(self, stage):
+        jobs = asyncio.Queue(maxsize=len(self.sessions) * 2)
+        workers = [asyncio.create_task(self._async_worker(jobs, session)) for session in self.sessions]
+        items = iter(stage)
+        while True:
+            item = await asyncio.to_thread(next, items, STOP)
+            if item is STOP:
+                break
+            await jobs.put(item)
+        for _ in workers:
+            await jobs.put(None)
+        await asyncio.gather(*workers)
+
+    async def _async_worker(self, jobs, session):
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(jobs.get(), self.keepalive_seconds or None)
+                except asyncio.TimeoutError:
+                    await session.keepalive()
+                    continue
+                if item is None:
+                    return
+                # cProfile cannot isolate one coroutine, so the async engine ignores the profile flag
+                msg, on_done, _ = item
+                with collect_timings() as timings:
+                    error = await self._deliver_async(session, msg)
+                if self.metrics is not None:
+                    self.metrics.merge(timings)
+                on_done(error)
+        finally:
+            await session.close()
+
+    async def _deliver_async(self, session, msg):
+        attempt = 0
+        while True:
+            try:
+                if self.limiter is not None:
+                    await self.limiter.acquire_async()
+                await session.send(msg)
+            except Exception as e:
+                if self.limiter is None or smtp_code(e) not in THROTTLE_CODES or attempt >= self.throttle_retries:
+                    return e
+                attempt += 1
+                session.reset()
+                delay = self.limiter.throttled()
+                print(f"  .. Throttled ({smtp_code(e)}), backing off {delay:.1f}s at {self.limiter.rate:.2f} msg/s")
+            else:
+                if self.limiter is not None:
+                    self.limiter.succeeded()
+                return None
+
+
+def make_pool(email_settings, limiter=None, metrics=None, profiler=None):
+    transport = email_settings.get("transport", "sync")
+    if transport == "async":
+        return AsyncSMTPPool(email_settings, limiter=limiter, metrics=metrics)
+    if transport != "sync":
+        raise ValueError(f"Unknown transport: {transport}")
+    return SMTPPool(email_settings, limiter=limiter, metrics=metrics, profiler=profiler)
@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import base64
+import json
+import random
+import ssl
+import threading
+import time
+from email import policy
+from email.parser import BytesParser
+
+
+class SMTPSink:
+    # Local SMTP server that accepts and counts every message without
+    # delivering it, for load tests that must not touch a real provider.
+    # It can also misbehave on purpose: throttle replies, dropped connections
+    # and malformed-message rejection when verify is on.
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=2525,
+        latency=0.0,
+        certfile=None,
+        keyfile=None,
+        verify=False,
+        throttle_rate=0.0,
+        disconnect_rate=0.0,
+        seed=None,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.verify = verify
+        self.throttle_rate = throttle_rate
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.ssl_context = None
+        if certfile:
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self.messages = 0
+        self.bytes_received = 0
+        self.sessions = 0
+        self.throttled = 0
+        self.disconnects = 0
+        self.rejected = 0
+        self.started = time.monotonic()
+        self._server = None
+
+    async def serve(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, limit=1 << 20)
+        self.port = self._server.sockets[0].getsockname()[1]
+        async with self._server:
+            await self._server.serve_forever()
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "messages": self.messages,
+            "bytes": self.bytes_received,
+            "sessions": self.sessions,
+            "throttled": self.throttled,
+            "disconnects": self.disconnects,
+            "rejected": self.rejected,
+            "messages_per_second": round(self.messages / elapsed, 2) if elapsed else 0.0,
+        }
+
+    def _capabilities(self, tls_active):
+        lines = ["sink", "8BITMIME", "SIZE 52428800", "AUTH PLAIN LOGIN"]
+        if self.ssl_context is not None and not tls_active:
+            lines.append("STARTTLS")
+        return lines
+
+    async def _handle(self, reader, writer):
+        self.sessions += 1
+        tls_active = False
+
+        async def reply(*lines):
+            for line in lines[:-1]:
+                writer.write(line.encode() + b"\r\n")
+            writer.write(lines[-1].encode() + b"\r\n")
+            await writer.drain()
+
+        try:
+            await reply("220 sink ESMTP ready")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                command = line.decode("utf-8", "replace").strip()
+                verb = command.split(" ", 1)[0].upper()
+
+                if verb in ("EHLO", "HELO"):
+                    caps = self._capabilities(tls_active)
+                    await reply(*[f"250-{cap}" for cap in caps[:-1]], f"250 {caps[-1]}")
+                elif verb == "STARTTLS" and self.ssl_context is not None and not tls_active:
+                    await reply("220 Ready to start TLS")
+                    await writer.start_tls(self.ssl_context)
+                    tls_active = True
+                elif verb == "AUTH":
+                    parts = command.split()
+                    if parts[1].upper() == "LOGIN":
+                        if len(parts) < 3:
+                            await reply("334 " + base64.b64encode(b"Username:").decode())
+                            await reader.readline()
+                        await reply("334 " + base64.b64encode(b"Password:").decode())
+                        await reader.readline()
+                    await reply("235 2.7.0 Authentication successful")
+                elif verb == "MAIL" and self.random.random() < self.throttle_rate:
+                    self.throttled += 1
+                    await reply("421 4.7.0 Try again later, closing connection")
+                    return
+                elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                    await reply("250 OK")
+                elif verb == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    chunks = []
+                    while True:
+                        chunk = await reader.readline()
+                        if not chunk:
+                            return
+                        if chunk == b".\r\n":
+                            break
+                        chunks.append(chunk[1:] if chunk.startswith(b"..") else chunk)
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    if self.random.random() < self.disconnect_rate:
+                        self.disconnects += 1
+                        return
+                    data = b"".join(chunks)
+                    if self.verify and not self._valid(data):
+                        self.rejected += 1
+                        await reply("554 5.6.0 Message rejected: missing headers or attachment")
+                        continue
+                    self.messages += 1
+                    self.bytes_received += len(data)
+                    await reply("250 2.0.0 queued")
+                elif verb == "QUIT":
+                    await reply("221 Bye")
+                    return
+                else:
+                    await reply("502 Command not implemented")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+    @staticmethod
+    def _valid(data):
+        msg = BytesParser(policy=policy.default).parsebytes(data)
+        if not msg["To"] or not msg["From"] or not msg["Subject"]:
+            return False
+        attachments = list(msg.iter_attachments())
+        return bool(attachments) and all(part.get_content() for part in attachments)
+
+
+def start_in_thread(sink):
+    # Runs the sink on its own event loop; returns once it is listening
+    ready = threading.Event()
+
+    def run():
+        async def main():
+            task = asyncio.ensure_future(sink.serve())
+            while sink._server is None and not task.done():
+                await asyncio.sleep(0.01)
+            ready.set()
+            await task
+
+        asyncio.run(main())
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    ready.wait()
+    return thread
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local SMTP sink for load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before acknowledging DATA")
+    parser.add_argument("--certfile", help="PEM certificate; enables STARTTLS")
+    parser.add_argument("--keyfile", help="PEM private key for --certfile")
+    parser.add_argument("--verify", action="store_true", help="reject messages without headers or an attachment")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="probability of a 421 reply to MAIL")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="probability of dropping the connection after DATA")
+    parser.add_argument("--seed", type=int, help="random seed for reproducible misbehaviour")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sink = SMTPSink(
+        args.host,
+        args.port,
+        args.latency,
+        args.certfile,
+        args.keyfile,
+        verify=args.verify,
+        throttle_rate=args.throttle_rate,
+        disconnect_rate=args.disconnect_rate,
+        seed=args.seed,
+    )
+    print(f"SMTP sink listening on {args.host}:{args.port}", flush=True)
+    try:
+        asyncio.run(sink.serve())
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(sink.stats()), flush=True)
+
+
+if __name__ == "__main__":
+    main()
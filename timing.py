@@ -0,0 +1,176 @@
+import bisect
+import contextlib
+import contextvars
+import cProfile
+import marshal
+import pstats
+import random
+import threading
+import time
+
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+@contextlib.contextmanager
+def timed(step):
+    # Adds the block's duration to the collector of the current thread or task, if any
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[step] = timings.get(step, 0.0) + time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def collect_timings():
+    timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+class _ProfileDump:
+    # Lets pstats load a marshalled profile shipped back from a render worker
+    def __init__(self, dump):
+        self.dump = dump
+
+    def create_stats(self):
+        self.stats = marshal.loads(self.dump)
+
+
+# cProfile allows one active profiler per process (from Python 3.12 it sits
+# on sys.monitoring and a second enable() raises), so samples that would
+# overlap one already running are skipped
+_profiling = threading.Lock()
+
+
+@contextlib.contextmanager
+def sample_profile(enabled=True):
+    # Yields a running cProfile.Profile, whose stats are ready once the block
+    # exits, or None when disabled or when another sample is in progress
+    if not enabled or not _profiling.acquire(blocking=False):
+        yield None
+        return
+    try:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Some other tool (a debugger, coverage) holds the profiling hook
+            profile = None
+        try:
+            yield profile
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.create_stats()
+    finally:
+        _profiling.release()
+
+
+class Profiler:
+    # Samples every Nth recipient with cProfile and merges the results
+    def __init__(self, every=0):
+        self.every = every
+        self.samples = 0
+        self.stats = None
+        self._lock = threading.Lock()
+
+    def wants(self, idx):
+        return bool(self.every) and idx % self.every == 0
+
+    @contextlib.contextmanager
+    def profile(self, enabled=True):
+        with sample_profile(enabled) as profile:
+            yield
+        if profile is not None:
+            self.add(marshal.dumps(profile.stats))
+
+    def add(self, dump):
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(_ProfileDump(dump))
+            else:
+                self.stats.add(_ProfileDump(dump))
+            self.samples += 1
+
+    def dump(self, path):
+        if self.stats is not None:
+            self.stats.dump_stats(path)
+
+
+class LatencyStats:
+    # Reservoir sample, so long runs keep a bounded number of samples
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.count = 0
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.count += 1
+            if len(self.samples) < self.max_samples:
+                self.samples.append(seconds)
+            else:
+                slot = random.randrange(self.count)
+                if slot < self.max_samples:
+                    self.samples[slot] = seconds
+
+    def percentile(self, pct):
+        with self._lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+    def summary(self):
+        return {"count": self.count, "p50": self.percentile(50), "p99": self.percentile(99)}
+
+
+class Metrics:
+    # Aggregates per-step timings (see timed()) into latency percentiles and histograms
+    BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.steps = {}
+        self._lock = threading.Lock()
+
+    def merge(self, timings):
+        for step, seconds in timings.items():
+            with self._lock:
+                entry = self.steps.get(step)
+                if entry is None:
+                    entry = self.steps[step] = {
+                        "stats": LatencyStats(),
+                        "total": 0.0,
+                        "max": 0.0,
+                        "buckets": [0] * (len(self.BUCKETS_MS) + 1),
+                    }
+                entry["total"] += seconds
+                entry["max"] = max(entry["max"], seconds)
+                entry["buckets"][bisect.bisect_left(self.BUCKETS_MS, seconds * 1000)] += 1
+            entry["stats"].add(seconds)
+
+    def report(self):
+        report = {}
+        for step, entry in sorted(self.steps.items()):
+            stats = entry["stats"]
+            labels = [f"<={edge}ms" for edge in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+            report[step] = {
+                "count": stats.count,
+                "total_s": round(entry["total"], 4),
+                "mean_ms": round(entry["total"] / stats.count * 1000, 3),
+                "p50_ms": round(stats.percentile(50) * 1000, 3),
+                "p90_ms": round(stats.percentile(90) * 1000, 3),
+                "p99_ms": round(stats.percentile(99) * 1000, 3),
+                "max_ms": round(entry["max"] * 1000, 3),
+                "histogram": {label: n for label, n in zip(labels, entry["buckets"]) if n},
+            }
+        return report
@@ -0,0 +1,140 @@
+import contextlib
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    grp TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires);
+"""
+
+
+class WorkQueue:
+    # Recipient queue shared by worker processes through one SQLite file.
+    # A worker leases a batch for visibility_timeout seconds; rows whose lease
+    # runs out (the worker died or hung) become available to the next lease.
+    # Every process must reach the file through a filesystem with working
+    # locks: a local disk, or a shared mount that supports POSIX locking.
+    def __init__(self, path, visibility_timeout=300.0, max_attempts=5):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def enqueue(self, recipients):
+        # recipients yields (key, name, email, group); keys already queued are left alone
+        now = time.time()
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs (key, name, email, grp, state, updated) VALUES (?, ?, ?, ?, 'queued', ?)",
+                ((key, name, email, group, now) for key, name, email, group in recipients),
+            )
+            return conn.total_changes - before
+
+    def lease(self, owner, count):
+        # Returns up to count (id, key, name, email, group) rows now owned by owner
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', owner = NULL, updated = ? "
+                "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            )
+            rows = conn.execute(
+                "SELECT id, key, name, email, grp FROM jobs "
+                "WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?) ORDER BY id LIMIT ?",
+                (now, count),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? "
+                "WHERE id = ?",
+                ((owner, now + self.visibility_timeout, now, row[0]) for row in rows),
+            )
+        return rows
+
+    def renew(self, owner):
+        # Pushes back the expiry of everything owner still holds
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE owner = ? AND state = 'leased'",
+                (now + self.visibility_timeout, owner),
+            )
+
+    def complete(self, owner, key, state):
+        # state is 'done' or 'failed'; a lease that was lost to another worker is not overwritten
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = ?, owner = NULL, updated = ? WHERE key = ? AND owner = ? AND state = 'leased'",
+                (state, time.time(), key, owner),
+            )
+
+    def defer(self, owner, key):
+        # Puts one row back, e.g. when the sender's daily budget ran out; it does not count as an attempt
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'queued', owner = NULL, attempts = attempts - 1, updated = ? "
+                "WHERE key = ? AND owner = ? AND state = 'leased'",
+                (time.time(), key, owner),
+            )
+
+    def release(self, owner):
+        # Hands back whatever owner did not finish, e.g. after Ctrl+C
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'queued', owner = NULL, attempts = attempts - 1, updated = ? "
+                "WHERE owner = ? AND state = 'leased'",
+                (time.time(), owner),
+            )
+
+    def pending(self, exclude_owner=None):
+        # Rows another worker could still finish or hand back through an expired lease
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'queued' OR (state = 'leased' AND owner IS NOT ?)",
+                (exclude_owner,),
+            ).fetchone()
+        return row[0]
+
+    def counts(self):
+        with self._lock:
+            return dict(self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers cannot
+        # select the same free rows before either marks them leased
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")